@@ -5,10 +5,11 @@ dataset_path="./data/spider/dev.json"
 db_dir="database"
 output_dataset_path="predicted_sql.txt"
 
-processed_dataset_path="./generate_datasets/C3_dev.json"
+processed_dataset_path="./generate_datasets/C3_dev.jsonl"
 
 # preprocess data
 bash scripts/prepare_dataset.sh $tables $dataset_path $db_dir $processed_dataset_path
 # run prediction
-python src/generate_sqls_by_gpt3.5.py --input_dataset_path $processed_dataset_path  --output_dataset_path $output_dataset_path --db_dir $db_dir
+python src/generate_sqls_by_gpt3.5.py --input_dataset_path $processed_dataset_path  --output_dataset_path $output_dataset_path --db_dir $db_dir \
+    --completion_cache_path "./generate_datasets/completion_cache.sqlite"
 
@@ -17,26 +17,33 @@ echo "preprocessing..."
 python src/preprocessing.py \
     --mode "test" \
     --table_path $tables \
+    --schema_cache_path "./generate_datasets/tables.schemas.pkl" \
     --input_dataset_path $dataset_path \
-    --output_dataset_path "./generate_datasets/preprocessed_data.json" \
+    --output_dataset_path "./generate_datasets/preprocessed_data.jsonl" \
     --db_path "$db_path" \
-    --target_type "sql"
+    --target_type "sql" \
+    --picklist_cache_dir "./generate_datasets/picklist_cache" \
+    --column_profile_dir "./generate_datasets/column_profiles"
 
 # recall tables
 echo "recall tables..."
 python src/table_recall.py \
-    --input_dataset_path "./generate_datasets/preprocessed_data.json" \
-    --output_recalled_tables_path "./generate_datasets/table_recall.json" \
+    --input_dataset_path "./generate_datasets/preprocessed_data.jsonl" \
+    --output_recalled_tables_path "./generate_datasets/table_recall.jsonl" \
+    --table_path $tables \
+    --schema_cache_path "./generate_datasets/tables.schemas.pkl" \
+    --completion_cache_path "./generate_datasets/completion_cache.sqlite"
 
 # recall columns
 echo "recall columns..."
 python src/column_recall.py \
-    --input_recalled_tables_path "./generate_datasets/table_recall.json" \
-    --output_recalled_columns_path "./generate_datasets/column_recall.json" \
+    --input_recalled_tables_path "./generate_datasets/table_recall.jsonl" \
+    --output_recalled_columns_path "./generate_datasets/column_recall.jsonl" \
+    --completion_cache_path "./generate_datasets/completion_cache.sqlite"
 
 # generate prompt
 echo "generate prompt..."
 python src/prompt_generate.py \
-    --input_dataset_path "./generate_datasets/column_recall.json" \
+    --input_dataset_path "./generate_datasets/column_recall.jsonl" \
     --output_dataset_path $processed_dataset_path \
 
@@ -7,11 +7,18 @@
  Encode DB content.
 """
 
+import bisect
 import difflib
+import re
+from collections import Counter, defaultdict
 from typing import List, Optional, Tuple
-from rapidfuzz import fuzz
-import sqlite3
+from rapidfuzz import fuzz, process
 import functools
+import column_profile
+import fts_index
+import picklist_cache
+import sqlite_pool
+import value_sketch
 
 # fmt: off
 _stopwords = {'who', 'ourselves', 'down', 'only', 'were', 'him', 'at', "weren't", 'has', 'few', "it's", 'm', 'again',
@@ -118,6 +125,30 @@ def get_effective_match_source(s: str, start: int, end: int) -> Match:
     return Match(_start, _end - _start + 1)
 
 
+def get_fuzzy_scores(pairs: List[Tuple[str, str]], score_cutoff: float = 0) -> List[float]:
+    """
+    ``fuzz.ratio(field_value, source_match_str) / 100`` of every (field_value, source_match_str) pair,
+    computed with one ``process.extract`` call per distinct source string; pairs scoring below
+    ``score_cutoff`` are skipped in native code and get 0.
+    """
+    scores = [0.0] * len(pairs)
+    pairs_by_source = defaultdict(list)
+    for i, (field_value, source_match_str) in enumerate(pairs):
+        pairs_by_source[source_match_str].append(i)
+    for source_match_str, ids in pairs_by_source.items():
+        results = process.extract(
+            source_match_str,
+            [pairs[i][0] for i in ids],
+            scorer=fuzz.ratio,
+            processor=None,
+            score_cutoff=score_cutoff * 100,
+            limit=None,
+        )
+        for _, score, j in results:
+            scores[ids[j]] = score / 100
+    return scores
+
+
 def get_matched_entries(
         s: str, field_values: List[str], m_theta: float = 0.85, s_theta: float = 0.85
 ) -> Optional[List[Tuple[str, Tuple[str, str, float, float, int]]]]:
@@ -129,7 +160,9 @@ def get_matched_entries(
     else:
         n_grams = s
 
-    matched = dict()
+    # first pass: longest matches and the rules which do not need a fuzzy score
+    candidates = []
+    fuzzy_pairs, fuzzy_candidate_ids = [], []
     for field_value in field_values:
         if not isinstance(field_value, str):
             continue
@@ -163,28 +196,40 @@ def get_matched_entries(
                         match_score = 1.0
                     else:
                         if prefix_match(c_field_value, c_source_match_str):
-                            match_score = (
-                                    fuzz.ratio(c_field_value, c_source_match_str) / 100
-                            )
+                            # scored below, in one batch
+                            match_score = None
+                            fuzzy_pairs.append((c_field_value, c_source_match_str))
+                            fuzzy_candidate_ids.append(len(candidates))
                         else:
                             match_score = 0
-                    if (
-                            is_commonword(c_match_str)
-                            or is_commonword(c_source_match_str)
-                            or is_commonword(c_field_value)
-                    ) and match_score < 1:
-                        continue
-                    s_match_score = match_score
-                    if match_score >= m_theta and s_match_score >= s_theta:
-                        if field_value.isupper() and match_score * s_match_score < 1:
-                            continue
-                        matched[match_str] = (
-                            field_value,
-                            source_match_str,
-                            match_score,
-                            s_match_score,
-                            match.size,
-                        )
+                    candidates.append([field_value, match_str, source_match_str, match.size, match_score,
+                                       c_match_str, c_source_match_str, c_field_value])
+
+    # scores below the thresholds are rejected anyway, keep a margin for the division by 100
+    score_cutoff = max(0.0, max(m_theta, s_theta) - 1e-6)
+    for candidate_id, match_score in zip(fuzzy_candidate_ids, get_fuzzy_scores(fuzzy_pairs, score_cutoff)):
+        candidates[candidate_id][4] = match_score
+
+    matched = dict()
+    for (field_value, match_str, source_match_str, match_size, match_score,
+         c_match_str, c_source_match_str, c_field_value) in candidates:
+        if (
+                is_commonword(c_match_str)
+                or is_commonword(c_source_match_str)
+                or is_commonword(c_field_value)
+        ) and match_score < 1:
+            continue
+        s_match_score = match_score
+        if match_score >= m_theta and s_match_score >= s_theta:
+            if field_value.isupper() and match_score * s_match_score < 1:
+                continue
+            matched[match_str] = (
+                field_value,
+                source_match_str,
+                match_score,
+                s_match_score,
+                match_size,
+            )
 
     if not matched:
         return None
@@ -196,32 +241,138 @@ def get_matched_entries(
         )
 
 
+def normalize_for_index(s: str) -> str:
+    # lower case char by char (as ``split'' does) and fold the final sigma, which is the only
+    # context-sensitive mapping of str.lower(), so that sub-spans and whole strings agree
+    return "".join(split(s)).replace("\u03c2", "\u03c3")
+
+
+def get_char_ngrams(s: str, n: int = 2) -> Counter:
+    return Counter(s[i: i + n] for i in range(len(s) - n + 1))
+
+
+# a separator followed by "'s" is the only way a single-character match can score 1.0
+_possessive_after_separator = re.compile("[{}]'s".format(re.escape("'\"()`,.?!")))
+
+
 @functools.lru_cache(maxsize=1000, typed=False)
+def get_question_ngrams(question: str) -> Counter:
+    return get_char_ngrams(normalize_for_index(question))
+
+
+class ValueIndex(object):
+    """
+    Character-bigram inverted index over the field values of one column.
+
+    ``shortlist'' returns the field values (in their original order) which may produce a match in
+    ``get_matched_entries'', every other value is guaranteed to be rejected there:
+      * a longest match of two or more characters implies a shared bigram;
+      * a fuzzy score of at least theta > 0.75 implies, by the q-gram count filter for the indel
+        distance, at least len(value) * (4 * theta - 3) - 1 bigrams shared with the question;
+      * a score of 1.0 from the "'s" rule needs a shared bigram, except after a separator.
+    Values which are not stripped are always kept, since their match spans are misaligned.
+    """
+
+    def __init__(self, field_values: List[str]) -> None:
+        self.field_values = field_values
+        self.postings = defaultdict(list)
+        self.lengths = dict()
+        unindexed = []
+        for idx, field_value in enumerate(field_values):
+            if not isinstance(field_value, str):
+                continue
+            if field_value != field_value.strip():
+                unindexed.append(idx)
+                continue
+            key = normalize_for_index(field_value)
+            self.lengths[idx] = len(key)
+            for gram, count in get_char_ngrams(key).items():
+                self.postings[gram].append((idx, count))
+        self.unindexed = unindexed
+        # indexed values sorted by length, to find the short ones without a full scan
+        self.by_length = sorted(self.lengths, key=lambda idx: self.lengths[idx])
+        self.sorted_lengths = [self.lengths[idx] for idx in self.by_length]
+
+    def shortlist(self, s: str, m_theta: float = 0.85, s_theta: float = 0.85) -> List[str]:
+        # keep a small margin for the floating point comparison of the fuzzy score
+        slope = 4 * (max(m_theta, s_theta) - 1e-9) - 3
+        if slope <= 0 or not isinstance(s, str) or s != s.strip():
+            return self.field_values
+        question = normalize_for_index(s)
+        if _possessive_after_separator.search(question):
+            return self.field_values
+        possessive = "'s" in question
+
+        overlaps = defaultdict(int)
+        for gram, question_count in get_question_ngrams(s).items():
+            for idx, count in self.postings.get(gram, ()):
+                overlaps[idx] += min(count, question_count)
+
+        # values with len(value) * slope <= 1 can not be ruled out by the count filter
+        num_short = bisect.bisect_right(self.sorted_lengths, 1 / slope)
+        candidates = set(self.unindexed)
+        candidates.update(self.by_length[:num_short])
+        for idx, overlap in overlaps.items():
+            if possessive or overlap >= self.lengths[idx] * slope - 1:
+                candidates.add(idx)
+        return [self.field_values[idx] for idx in sorted(candidates)]
+
+
 def get_column_picklist(table_name: str, column_name: str, db_path: str) -> list:
-    fetch_sql = "SELECT DISTINCT `{}` FROM `{}`".format(column_name, table_name)
-    try:
+    return picklist_cache.picklist_store.get(db_path, table_name, column_name, fetch_column_picklist)
+
+
+def fetch_column_picklist(table_name: str, column_name: str, db_path: str) -> list:
+    # only text values can be matched, the numbers are left in the database
+    fetch_sql = "SELECT DISTINCT `{0}` FROM `{1}` WHERE typeof(`{0}`) IN ('text', 'blob')".format(
+        column_name, table_name)
+    profiler = column_profile.column_profiler
+    with sqlite_pool.connection_pool.connection(db_path, bytes) as conn:
         # print(f"db_path: {db_path}")
-        conn = sqlite3.connect(db_path)
-        conn.text_factory = bytes
         c = conn.cursor()
         c.execute(fetch_sql)
         picklist = set()
-        for x in c.fetchall():
-            if isinstance(x[0], str):
-                picklist.add(x[0].encode("utf-8"))
-            elif isinstance(x[0], bytes):
-                try:
-                    picklist.add(x[0].decode("utf-8"))
-                except UnicodeDecodeError:
-                    picklist.add(x[0].decode("latin-1"))
-            else:
-                picklist.add(x[0])
+        num_bytes = 0
+        # read the values in chunks, up to the memory cap of a column
+        while profiler.max_column_bytes is None or num_bytes < profiler.max_column_bytes:
+            rows = c.fetchmany(profiler.chunk_size)
+            if not rows:
+                break
+            for x in rows:
+                if isinstance(x[0], str):
+                    picklist.add(x[0].encode("utf-8"))
+                elif isinstance(x[0], bytes):
+                    num_bytes += len(x[0])
+                    try:
+                        picklist.add(x[0].decode("utf-8"))
+                    except UnicodeDecodeError:
+                        picklist.add(x[0].decode("latin-1"))
+                else:
+                    picklist.add(x[0])
+        else:
+            print(f"picklist of {table_name}.{column_name} in {db_path} truncated to {len(picklist)} values")
         picklist = list(picklist)
-    finally:
-        conn.close()
     return picklist
 
 
+def get_column_value_index(table_name: str, column_name: str, db_path: str) -> ValueIndex:
+    # keyed by the signature of the file too, so that a changed database is indexed again
+    return get_column_value_index_(table_name, column_name, db_path,
+                                   tuple(picklist_cache.get_db_signature(db_path)))
+
+
+@functools.lru_cache(maxsize=1000, typed=False)
+def get_column_value_index_(table_name: str, column_name: str, db_path: str, signature: tuple) -> ValueIndex:
+    picklist = get_column_picklist(
+        table_name=table_name, column_name=column_name, db_path=db_path
+    )
+    # only maintain data in ``str'' type
+    picklist = [ele.strip() for ele in picklist if isinstance(ele, str)]
+    # picklist is unordered, we sort it to ensure the reproduction stability
+    picklist = sorted(picklist)
+    return ValueIndex(picklist)
+
+
 def get_database_matches(
         question: str,
         table_name: str,
@@ -229,19 +380,31 @@ def get_database_matches(
         db_path: str,
         top_k_matches: int = 2,
         match_threshold: float = 0.85,
+        approximate: bool = True,
 ) -> List[str]:
-    picklist = get_column_picklist(
-        table_name=table_name, column_name=column_name, db_path=db_path
-    )
-    # only maintain data in ``str'' type
-    picklist = [ele.strip() for ele in picklist if isinstance(ele, str)]
-    # picklist is unordered, we sort it to ensure the reproduction stability
-    picklist = sorted(picklist)
+    # the columns of the skipped kinds (see column_profile) are not matched
+    if column_profile.column_profiler.should_skip(db_path, table_name, column_name):
+        return []
+    # high-cardinality columns with a value sketch are shortlisted approximately, and so are the
+    # columns of a database with an fts sidecar, without loading their picklist
+    sketch = value_sketch.value_sketch_store.get(db_path, table_name, column_name) if approximate else None
+    field_values = None
+    if sketch is not None:
+        picklist = sketch.field_values
+        field_values = value_sketch.value_sketch_store.shortlist(sketch, question)
+    elif approximate:
+        field_values = picklist = fts_index.fts_store.shortlist(db_path, table_name, column_name, question)
+    if field_values is None:
+        index = get_column_value_index(
+            table_name=table_name, column_name=column_name, db_path=db_path
+        )
+        picklist = index.field_values
+        field_values = index.shortlist(question, match_threshold, match_threshold)
     matches = []
     if picklist and isinstance(picklist[0], str):
         matched_entries = get_matched_entries(
             s=question,
-            field_values=picklist,
+            field_values=field_values,
             m_theta=match_threshold,
             s_theta=match_threshold,
         )
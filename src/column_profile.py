@@ -0,0 +1,201 @@
+"""
+ Profiles of the database columns, used to decide how their values are bridged.
+
+ A profile records the declared type of a column, its number of rows, of distinct values and of
+ distinct text values, and the average length of its text values, from a single aggregate query.
+ Every column gets a ``kind'':
+   * ``empty'': no value at all;
+   * ``numeric'': no text value, so it can never match the question;
+   * ``date'': declared as a date, time or timestamp;
+   * ``id'': named ``id'' or ``*_id'';
+   * ``text'': anything else.
+ Columns of the kinds in ``skip_kinds`` are not bridged, and the picklists of the others are read in
+ chunks of ``chunk_size`` values and truncated once they hold ``max_column_bytes`` bytes. Deciding
+ whether to skip a column does not scan it unless ``text`` columns are skipped: empty and numeric
+ columns have an empty (text only) picklist, which matches nothing anyway, and date and id columns
+ are told by their declared type and name. Profiles are kept per database file (invalidated by its
+ mtime and size) and saved under ``profile_dir``.
+"""
+
+import os
+import re
+import json
+import argparse
+import functools
+import threading
+
+from picklist_cache import get_db_key, is_changed_column, is_current_entry
+import sqlite_pool
+from sqlite_pool import get_db_signature, atomic_write
+
+# "date" and "id" columns are opt-in, their values still match questions (a month, a product code)
+DEFAULT_SKIP_KINDS = ("empty", "numeric")
+_date_type = re.compile("date|time", re.IGNORECASE)
+_id_name = re.compile(r"(^|[_ ])id$", re.IGNORECASE)
+
+
+def get_column_kind(column_name: str, profile: dict) -> str:
+    if profile["num_rows"] == 0 or profile["num_distinct"] == 0:
+        return "empty"
+    if profile["num_distinct_text"] == 0:
+        return "numeric"
+    if _date_type.search(profile["declared_type"]):
+        return "date"
+    if _id_name.search(column_name):
+        return "id"
+    return "text"
+
+
+@functools.lru_cache(maxsize=1000, typed=False)
+def get_declared_types(db_path: str, table_name: str, signature: tuple) -> dict:
+    """Lowercased column name -> declared type, for the ``signature`` of the database file."""
+    with sqlite_pool.connection_pool.connection(db_path) as conn:
+        return {row[1].lower(): row[2] for row in conn.execute("PRAGMA table_info(`{}`)".format(table_name))}
+
+
+def profile_column(db_path: str, table_name: str, column_name: str) -> dict:
+    declared_types = get_declared_types(os.path.abspath(db_path), table_name, tuple(get_db_signature(db_path)))
+    text_value = "CASE WHEN typeof(`{0}`) IN ('text', 'blob') THEN `{0}` END".format(column_name)
+    profile_sql = "SELECT COUNT(*), COUNT(DISTINCT `{0}`), COUNT(DISTINCT {1}), AVG(length({1})) FROM `{2}`".format(
+        column_name, text_value, table_name)
+    with sqlite_pool.connection_pool.connection(db_path) as conn:
+        num_rows, num_distinct, num_distinct_text, avg_length = conn.execute(profile_sql).fetchone()
+    profile = {
+        "declared_type": declared_types.get(column_name.lower(), ""),
+        "num_rows": num_rows,
+        "num_distinct": num_distinct,
+        "num_distinct_text": num_distinct_text,
+        "avg_length": avg_length or 0.0,
+    }
+    profile["kind"] = get_column_kind(column_name, profile)
+    return profile
+
+
+class ColumnProfiler(object):
+    def __init__(self, profile_dir: str = None, skip_kinds=DEFAULT_SKIP_KINDS,
+                 max_column_bytes: int = 64 * 1024 * 1024, chunk_size: int = 10000) -> None:
+        self.profile_dir = profile_dir
+        self.skip_kinds = set(skip_kinds)
+        self.max_column_bytes = max_column_bytes
+        self.chunk_size = chunk_size
+        # db path -> (signature, {"table\tcolumn": profile})
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def get(self, db_path: str, table_name: str, column_name: str) -> dict:
+        signature = get_db_signature(db_path)
+        abs_db_path = os.path.abspath(db_path)
+        key = "{}\t{}".format(table_name, column_name)
+        with self.lock:
+            if self.profiles.get(abs_db_path, (None,))[0] != signature:
+                self.profiles[abs_db_path] = (signature, self._load(db_path, signature))
+            _, db_profiles = self.profiles[abs_db_path]
+            if key in db_profiles:
+                return db_profiles[key]
+
+        profile = profile_column(db_path, table_name, column_name)
+        with self.lock:
+            db_profiles[key] = profile
+            self._save(db_path, signature, db_profiles)
+        return profile
+
+    def should_skip(self, db_path: str, table_name: str, column_name: str) -> bool:
+        if "text" in self.skip_kinds:
+            return self.get(db_path, table_name, column_name)["kind"] in self.skip_kinds
+        # the picklists of empty and numeric columns are empty, which skips them without a profile
+        if "id" in self.skip_kinds and _id_name.search(column_name):
+            return True
+        if "date" in self.skip_kinds:
+            signature = tuple(get_db_signature(db_path))
+            declared_types = get_declared_types(os.path.abspath(db_path), table_name, signature)
+            return _date_type.search(declared_types.get(column_name.lower(), "")) is not None
+        return False
+
+    def refresh(self, db_path: str, changed_columns=None, since_signature: list = None) -> None:
+        """Drop the profiles of ``changed_columns`` (all if None), keep the others for the current file."""
+        signature = get_db_signature(db_path)
+        abs_db_path = os.path.abspath(db_path)
+        with self.lock:
+            if abs_db_path in self.profiles:
+                saved_signature, db_profiles = self.profiles[abs_db_path]
+            else:
+                saved_signature, db_profiles = self._read(db_path)
+            if is_current_entry(saved_signature, signature, since_signature, changed_columns != []):
+                return
+            if saved_signature != since_signature:
+                db_profiles = {}
+            db_profiles = {key: profile for key, profile in db_profiles.items()
+                           if not is_changed_column(*key.split("\t"), changed_columns)}
+            self.profiles[abs_db_path] = (signature, db_profiles)
+            self._save(db_path, signature, db_profiles)
+
+    def _profile_path(self, db_path: str) -> str:
+        return os.path.join(self.profile_dir, get_db_key(db_path) + ".json")
+
+    def _read(self, db_path: str) -> tuple:
+        if self.profile_dir is not None and os.path.exists(self._profile_path(db_path)):
+            with open(self._profile_path(db_path)) as f:
+                saved = json.load(f)
+            return saved["signature"], saved["columns"]
+        return None, {}
+
+    def _load(self, db_path: str, signature: list) -> dict:
+        saved_signature, db_profiles = self._read(db_path)
+        return db_profiles if saved_signature == signature else {}
+
+    def _save(self, db_path: str, signature: list, db_profiles: dict) -> None:
+        if self.profile_dir is None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        saved = {"db_path": os.path.abspath(db_path), "signature": signature, "columns": db_profiles}
+        atomic_write(self._profile_path(db_path), json.dumps(saved).encode("utf-8"))
+
+
+column_profiler = ColumnProfiler()
+
+
+def configure_column_profiles(profile_dir: str = None, skip_kinds=DEFAULT_SKIP_KINDS,
+                              max_column_bytes: int = 64 * 1024 * 1024, chunk_size: int = 10000) -> ColumnProfiler:
+    global column_profiler
+    column_profiler = ColumnProfiler(profile_dir=profile_dir, skip_kinds=skip_kinds,
+                                     max_column_bytes=max_column_bytes, chunk_size=chunk_size)
+    return column_profiler
+
+
+def get_db_columns(db_path: str) -> list:
+    with sqlite_pool.connection_pool.connection(db_path) as conn:
+        table_names = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'")]
+        return [(table_name, row[1]) for table_name in table_names
+                for row in conn.execute("PRAGMA table_info(`{}`)".format(table_name))]
+
+
+def profile_database(db_path: str, profiler: ColumnProfiler) -> dict:
+    return {(table_name, column_name): profiler.get(db_path, table_name, column_name)
+            for table_name, column_name in get_db_columns(db_path)}
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for profiling the database columns")
+    parser.add_argument("--db_dir", type=str, default="./data/spider/database")
+    parser.add_argument("--db_ids", type=str, nargs="*", default=None,
+                        help="databases to profile, every database of db_dir if not given.")
+    parser.add_argument("--profile_dir", type=str, default=None,
+                        help="directory the profiles are saved to, only printed if not given.")
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    profiler = ColumnProfiler(profile_dir=opt.profile_dir)
+    for db_id in opt.db_ids or sorted(os.listdir(opt.db_dir)):
+        db_path = os.path.join(opt.db_dir, db_id, db_id + ".sqlite")
+        if not os.path.exists(db_path):
+            continue
+        for (table_name, column_name), profile in profile_database(db_path, profiler).items():
+            print(f"{db_id}\t{table_name}.{column_name}\t{profile['kind']}\t{profile['declared_type']}\t"
+                  f"{profile['num_distinct']} distinct\t{profile['num_distinct_text']} distinct text\t"
+                  f"avg length {profile['avg_length']:.1f}")
@@ -4,6 +4,9 @@ import openai
 import time
 from tqdm import tqdm
 from collections import Counter
+from dataset_io import read_dataset, write_dataset
+from llm_client import create_chat_completion
+from completion_cache import configure_completion_cache
 
 # add your openai api key
 openai.api_key = "sk-"
@@ -17,14 +20,21 @@ def parse_option():
                         help="Size of self-consistent set")
     parser.add_argument("--add_fk", type=bool, default=True)
     parser.add_argument("--output_recalled_columns_path", type=str)
+    parser.add_argument("--completion_cache_path", type=str, default=None,
+                        help="sqlite file caching the completions, no caching if not given.")
+    parser.add_argument("--completion_cache_ttl", type=float, default=None,
+                        help="seconds after which a cached completion expires.")
+    parser.add_argument("--completion_cache_max_mb", type=int, default=None,
+                        help="size (in MB) above which the least recently used completions are evicted.")
 
     opt = parser.parse_args()
 
     return opt
 
 
-def generate_reply(input, sc_num):
-    completions = openai.ChatCompletion.create(
+def generate_reply(input, sc_num, attempt=0):
+    completions = create_chat_completion(
+        attempt=attempt,
         model="gpt-3.5-turbo",
         messages=input,
         temperature=0.7,
@@ -168,16 +178,7 @@ Explain why you choose each column.
 
 '''
 
-if __name__ == "__main__":
-    opt = parse_option()
-    print(opt)
-    with open(opt.input_dataset_path) as f:
-        data_all = json.load(f)
-    res = []
-    if opt.self_consistent:
-        sc_num = opt.n
-    else:
-        sc_num = 1
+def recall_columns(data_all, sc_num):
     for i, data in enumerate(tqdm(data_all)):
         schema = generate_schema(data)
         prompt = instruction + 'Schema:\n' + schema
@@ -187,9 +188,12 @@ if __name__ == "__main__":
         prompt += "\nQuestion:\n### " + data["question"]
         # print(prompt)
         tabs_cols_all = None
+        attempt = 0
         while tabs_cols_all is None:
             try:
-                tabs_cols_all = generate_reply([{"role": "user", "content": prompt}], sc_num)
+                tabs_cols_all = generate_reply([{"role": "user", "content": prompt}], sc_num, attempt)
+                # an unparsable reply is asked again as a new attempt, not replayed from the cache
+                attempt += 1
             except:
                 print(f'api error, wait for 3 seconds and retry...')
                 time.sleep(3)
@@ -199,7 +203,17 @@ if __name__ == "__main__":
             tab_col_ori[table['table_name_original'].lower()] = table['column_names_original']
         tabs_cols = column_sc(tabs_cols_all, tab_col_ori, data['fk'])
         info = info_generate(tabs_cols, data)
-        res.append(info)
-        # print(res)
-        with open(opt.output_dataset_path, 'w') as f:
-            json.dump(res, f, indent=2)
+        yield info
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    print(opt)
+    configure_completion_cache(opt.completion_cache_path, opt.completion_cache_ttl,
+                               opt.completion_cache_max_mb * 1024 * 1024 if opt.completion_cache_max_mb else None)
+    if opt.self_consistent:
+        sc_num = opt.n
+    else:
+        sc_num = 1
+    data_all = read_dataset(opt.input_recalled_tables_path)
+    write_dataset(opt.output_recalled_columns_path, recall_columns(data_all, sc_num))
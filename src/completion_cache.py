@@ -0,0 +1,96 @@
+"""
+ On-disk cache of chat completions, backed by SQLite.
+
+ A completion is stored under the hash of its request (messages and sampling parameters) and an
+ ``attempt`` number, which tells apart the repeated requests a caller sends on purpose (e.g. to
+ ask again after an unusable reply): a re-run replays the same sequence of replies without calling
+ the API. Entries older than ``ttl`` seconds are ignored, and the least recently used entries are
+ evicted once the stored responses exceed ``max_size`` bytes.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def get_request_key(request: dict, attempt: int = 0) -> str:
+    content = json.dumps({"request": request, "attempt": attempt}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class CompletionCache(object):
+    def __init__(self, path: str, ttl: float = None, max_size: int = None) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # several stages (or processes) may share one cache file
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+    def get(self, request: dict, attempt: int = 0):
+        key = get_request_key(request, attempt)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            response, created = row
+            if self.ttl is not None and now - created > self.ttl:
+                self.connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return None
+            self.connection.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(response)
+
+    def put(self, request: dict, response: dict, attempt: int = 0) -> None:
+        key = get_request_key(request, attempt)
+        response = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO completions (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response), now, now),
+            )
+            self._evict()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM completions")
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            self.connection.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_size is None:
+            return
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        # drop the least recently used entries until the cache fits again
+        cursor = self.connection.execute("SELECT key, size FROM completions ORDER BY accessed")
+        evicted = []
+        for key, size in cursor:
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        cursor.close()
+        self.connection.executemany("DELETE FROM completions WHERE key = ?", evicted)
+
+
+completion_cache = None
+
+
+def configure_completion_cache(path: str = None, ttl: float = None, max_size: int = None) -> CompletionCache:
+    global completion_cache
+    completion_cache = CompletionCache(path, ttl=ttl, max_size=max_size) if path is not None else None
+    return completion_cache
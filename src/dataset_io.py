@@ -0,0 +1,92 @@
+"""
+ Reading and writing of the datasets passed between the stages of the pipeline.
+
+ A path ending with ``.jsonl'' holds one JSON record per line: records are read lazily and each
+ record is written (and flushed) as soon as it is produced, so stages can be chained as generators
+ in constant memory and a crash keeps every finished record. Any other path holds a single JSON
+ list, as written by the original scripts.
+
+ Records with a ``db_schema`` can be written normalized to a ``.jsonl'' path: the static part of
+ each table (names, types, ...) is written once per ``db_id`` in a schema record, the first time it
+ is needed, and the records only keep the table names and their question-specific ``db_contents``.
+ ``read_dataset`` skips the schema records and rehydrates the others one at a time as they are
+ read, so readers see the same records either way. A JSON list is always written in full, since
+ the scripts reading it with ``json.load`` expect complete records.
+"""
+
+import json
+
+# key of the records which hold the static part of the tables of a database
+SCHEMA_KEY = "__schema__"
+
+
+def is_jsonl(path: str) -> bool:
+    return path.endswith(".jsonl")
+
+
+def read_records(path: str):
+    with open(path) as f:
+        if is_jsonl(path):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for data in json.load(f):
+                yield data
+
+
+def read_dataset(path: str):
+    return rehydrate_records(read_records(path))
+
+
+def normalize_records(records):
+    # (db_id, table name) -> static part of the table as last written
+    written_tables = {}
+    for record in records:
+        if "db_schema" not in record:
+            yield record
+            continue
+        db_id = record["db_id"]
+        new_tables, light_tables = [], []
+        for table in record["db_schema"]:
+            static_table = {key: value for key, value in table.items() if key != "db_contents"}
+            if written_tables.get((db_id, table["table_name_original"])) != static_table:
+                written_tables[(db_id, table["table_name_original"])] = static_table
+                new_tables.append(static_table)
+            light_tables.append({"table_name_original": table["table_name_original"],
+                                 "db_contents": table["db_contents"]})
+        if new_tables:
+            yield {SCHEMA_KEY: db_id, "tables": new_tables}
+        record = dict(record)
+        record["db_schema"] = light_tables
+        yield record
+
+
+def rehydrate_records(records):
+    tables = {}
+    for record in records:
+        if SCHEMA_KEY in record:
+            for table in record["tables"]:
+                tables[(record[SCHEMA_KEY], table["table_name_original"])] = table
+            continue
+        if tables and "db_schema" in record:
+            db_id = record["db_id"]
+            db_schema = []
+            for table in record["db_schema"]:
+                full_table = dict(tables[(db_id, table["table_name_original"])])
+                full_table["db_contents"] = table["db_contents"]
+                db_schema.append(full_table)
+            record["db_schema"] = db_schema
+        yield record
+
+
+def write_dataset(path: str, records, normalize: bool = False) -> None:
+    if normalize and is_jsonl(path):
+        records = normalize_records(records)
+    with open(path, "w") as f:
+        if is_jsonl(path):
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+        else:
+            f.write(json.dumps(list(records), indent=2))
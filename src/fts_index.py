@@ -0,0 +1,220 @@
+"""
+ SQLite FTS5 sidecar indexes of the text values of a database, for question-to-value matching.
+
+ Every database gets a sidecar SQLite file under ``sidecar_dir`` holding one FTS5 table (trigram
+ tokenizer) of the distinct, stripped text values of each column which has any, filled by SQLite
+ itself from the attached database. Values shorter than a trigram are kept in a plain table. The
+ trigrams of the question words are matched against a column with ``MATCH`` and the
+ ``max_candidates`` best ranked values are handed to the exact matcher, so no picklist is ever loaded into memory.
+
+ A sidecar records the signature (mtime and size) of the database it was built from, and is built
+ again on first use once the database changed (``index_refresh.py`` only indexes the changed tables
+ again).
+"""
+
+import os
+import re
+import json
+import shutil
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+import column_profile
+from column_profile import get_db_columns
+from picklist_cache import get_db_key, is_current_entry
+import sqlite_pool
+from sqlite_pool import get_db_signature
+
+# bumped whenever the layout of a sidecar changes
+FTS_INDEX_VERSION = 1
+_question_words = re.compile("[^{}]+".format(re.escape("'\"()`,.?! \t\n")))
+# the characters str.strip() removes from an ascii value
+_strip_chars = "char(32, 9, 10, 11, 12, 13)"
+
+
+def get_match_query(question: str) -> str:
+    # any trigram of a question word, so that values found inside a word ("dog" in "dogs") match too
+    trigrams = {word[i: i + 3] for word in _question_words.findall(question.lower()) for i in range(len(word) - 2)}
+    return " OR ".join('"{}"'.format(trigram.replace('"', '""')) for trigram in sorted(trigrams))
+
+
+def index_columns(conn, db_path: str, columns) -> None:
+    """Index the text values of ``columns`` of the database attached to ``conn`` as ``source``."""
+    for table_name, column_name in columns:
+        if column_profile.column_profiler.get(db_path, table_name, column_name)["num_distinct_text"] == 0:
+            continue
+        column_id = conn.execute("INSERT INTO columns (table_name, column_name) VALUES (?, ?)",
+                                 (table_name.lower(), column_name.lower())).lastrowid
+        conn.execute("CREATE VIRTUAL TABLE c{} USING fts5(value, tokenize = 'trigram')".format(column_id))
+        values_sql = ("SELECT DISTINCT trim(CAST(`{0}` AS TEXT), {2}) AS value FROM source.`{1}` "
+                      "WHERE typeof(`{0}`) IN ('text', 'blob')").format(column_name, table_name, _strip_chars)
+        conn.execute("INSERT INTO c{0} (value) SELECT value FROM ({1}) WHERE length(value) >= 3".format(
+            column_id, values_sql))
+        # merge the b-trees of the index, which is never written again
+        conn.execute("INSERT INTO c{0} (c{0}) VALUES ('optimize')".format(column_id))
+        conn.execute("INSERT INTO short_values SELECT ?, value FROM ({}) WHERE length(value) < 3".format(
+            values_sql), (column_id,))
+
+
+def open_sidecar(db_path: str, tmp_path: str):
+    # opened by URI, so that the database is attached read-only
+    conn = sqlite3.connect(Path(os.path.abspath(tmp_path)).as_uri(), uri=True)
+    conn.execute("ATTACH DATABASE ? AS source", (Path(os.path.abspath(db_path)).as_uri() + "?mode=ro",))
+    return conn
+
+
+def build_fts_index(db_path: str, sidecar_path: str) -> None:
+    signature = get_db_signature(db_path)
+    tmp_path = "{}.{}.{}.tmp".format(sidecar_path, os.getpid(), threading.get_ident())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = open_sidecar(db_path, tmp_path)
+    try:
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE columns (id INTEGER PRIMARY KEY, table_name TEXT, column_name TEXT)")
+        conn.execute("CREATE TABLE short_values (column_id INTEGER, value TEXT)")
+        index_columns(conn, db_path, get_db_columns(db_path))
+        conn.execute("CREATE INDEX short_values_column ON short_values (column_id)")
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("version", str(FTS_INDEX_VERSION)),
+            ("db_path", os.path.abspath(db_path)),
+            ("signature", json.dumps(signature)),
+        ])
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, sidecar_path)
+
+
+def refresh_fts_index(db_path: str, sidecar_path: str, changed_columns) -> None:
+    """Index ``changed_columns`` again in a copy of the sidecar, which then replaces it."""
+    signature = get_db_signature(db_path)
+    changed_tables = {table_name.lower() for table_name, _ in changed_columns}
+    tmp_path = "{}.{}.{}.tmp".format(sidecar_path, os.getpid(), threading.get_ident())
+    shutil.copyfile(sidecar_path, tmp_path)
+    conn = open_sidecar(db_path, tmp_path)
+    try:
+        for column_id, table_name in conn.execute("SELECT id, table_name FROM columns").fetchall():
+            if table_name in changed_tables:
+                conn.execute("DROP TABLE c{}".format(column_id))
+                conn.execute("DELETE FROM short_values WHERE column_id = ?", (column_id,))
+                conn.execute("DELETE FROM columns WHERE id = ?", (column_id,))
+        index_columns(conn, db_path, [(table_name, column_name) for table_name, column_name in get_db_columns(db_path)
+                                      if table_name.lower() in changed_tables])
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'signature'", (json.dumps(signature),))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, sidecar_path)
+
+
+class FTSIndexStore(object):
+    def __init__(self, sidecar_dir: str = None, max_candidates: int = 100) -> None:
+        self.sidecar_dir = sidecar_dir
+        self.max_candidates = max_candidates
+        # db path -> (signature, {(table, column): column id})
+        self.indexes = {}
+        self.lock = threading.RLock()
+
+    def sidecar_path(self, db_path: str) -> str:
+        return os.path.join(self.sidecar_dir, get_db_key(db_path) + ".fts.sqlite")
+
+    def get_columns(self, db_path: str) -> Optional[dict]:
+        """Column ids of the sidecar of ``db_path``, built first if missing or out of date."""
+        if self.sidecar_dir is None:
+            return None
+        signature = get_db_signature(db_path)
+        abs_db_path = os.path.abspath(db_path)
+        with self.lock:
+            if self.indexes.get(abs_db_path, (None,))[0] == signature:
+                return self.indexes[abs_db_path][1]
+            sidecar_path = self.sidecar_path(db_path)
+            columns = self._read_columns(sidecar_path, signature)
+            if columns is None:
+                os.makedirs(self.sidecar_dir, exist_ok=True)
+                build_fts_index(db_path, sidecar_path)
+                columns = self._read_columns(sidecar_path, signature)
+            self.indexes[abs_db_path] = (signature, columns)
+            return columns
+
+    def shortlist(self, db_path: str, table_name: str, column_name: str, question: str) -> Optional[List[str]]:
+        """Candidate values of a column for ``question``, in picklist order; None if it is not indexed."""
+        columns = self.get_columns(db_path)
+        if columns is None or (table_name.lower(), column_name.lower()) not in columns:
+            return None
+        column_id = columns[(table_name.lower(), column_name.lower())]
+        match_query = get_match_query(question)
+        with sqlite_pool.connection_pool.connection(self.sidecar_path(db_path)) as conn:
+            values = [row[0] for row in conn.execute(
+                "SELECT value FROM short_values WHERE column_id = ?", (column_id,))]
+            if match_query:
+                values.extend(row[0] for row in conn.execute(
+                    "SELECT value FROM c{0} WHERE c{0} MATCH ? ORDER BY rank LIMIT ?".format(column_id),
+                    (match_query, self.max_candidates)))
+        return sorted(set(values))
+
+    def refresh(self, db_path: str, changed_columns=None, since_signature: list = None) -> None:
+        """
+        Make the sidecar of ``db_path`` valid for its current file: the tables of ``changed_columns``
+        are indexed again if it was built from the file of ``since_signature``, the whole database
+        otherwise (or if ``changed_columns`` is None).
+        """
+        if self.sidecar_dir is None or not os.path.exists(self.sidecar_path(db_path)):
+            return
+        signature = get_db_signature(db_path)
+        with self.lock:
+            with sqlite_pool.connection_pool.connection(self.sidecar_path(db_path)) as conn:
+                sidecar_signature = json.loads(dict(conn.execute("SELECT key, value FROM meta"))["signature"])
+            if is_current_entry(sidecar_signature, signature, since_signature, changed_columns != []):
+                return
+            if changed_columns is None or sidecar_signature != since_signature:
+                build_fts_index(db_path, self.sidecar_path(db_path))
+            else:
+                refresh_fts_index(db_path, self.sidecar_path(db_path), changed_columns)
+            self.indexes.pop(os.path.abspath(db_path), None)
+
+    def _read_columns(self, sidecar_path: str, signature: list) -> Optional[dict]:
+        if not os.path.exists(sidecar_path):
+            return None
+        with sqlite_pool.connection_pool.connection(sidecar_path) as conn:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            if meta["version"] != str(FTS_INDEX_VERSION) or json.loads(meta["signature"]) != signature:
+                return None
+            return {(table_name, column_name): column_id
+                    for column_id, table_name, column_name in conn.execute("SELECT * FROM columns")}
+
+
+fts_store = FTSIndexStore()
+
+
+def configure_fts_index(sidecar_dir: str = None, max_candidates: int = 100) -> FTSIndexStore:
+    global fts_store
+    fts_store = FTSIndexStore(sidecar_dir=sidecar_dir, max_candidates=max_candidates)
+    return fts_store
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for the fts sidecar indexes")
+    parser.add_argument("--db_dir", type=str, default="./data/spider/database")
+    parser.add_argument("--db_ids", type=str, nargs="*", default=None,
+                        help="databases to index, every database of db_dir if not given.")
+    parser.add_argument("--sidecar_dir", type=str, required=True)
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    os.makedirs(opt.sidecar_dir, exist_ok=True)
+    store = FTSIndexStore(sidecar_dir=opt.sidecar_dir)
+    for db_id in opt.db_ids or sorted(os.listdir(opt.db_dir)):
+        db_path = os.path.join(opt.db_dir, db_id, db_id + ".sqlite")
+        if not os.path.exists(db_path):
+            continue
+        build_fts_index(db_path, store.sidecar_path(db_path))
+        print(f"{db_id}: indexed {len(store.get_columns(db_path))} text columns")
@@ -1,12 +1,15 @@
 import argparse
 import json
 import time
+import hashlib
 import openai
 from sql_post_process import fix_select_column
-import re
 import os
-import sqlite3
-from get_selfconsistent_output import get_sqls
+from get_selfconsistent_output import choose_sqls
+from dataset_io import read_dataset
+from llm_client import create_chat_completion
+from completion_cache import configure_completion_cache
+from sql_validator import is_valid_sql
 from tqdm import tqdm
 
 # add your openai api key
@@ -51,14 +54,29 @@ def parse_option():
                         help="Size of self-consistent set")
     parser.add_argument("--output_dataset_path", type=str)
     parser.add_argument("--db_dir", type=str, default="./data/database")
+    parser.add_argument("--completion_cache_path", type=str, default=None,
+                        help="sqlite file caching the completions, no caching if not given.")
+    parser.add_argument("--completion_cache_ttl", type=float, default=None,
+                        help="seconds after which a cached completion expires.")
+    parser.add_argument("--completion_cache_max_mb", type=int, default=None,
+                        help="size (in MB) above which the least recently used completions are evicted.")
+    parser.add_argument("--checkpoint_path", type=str, default=None,
+                        help="journal of the generated sqls, <output_dataset_path>.checkpoint.jsonl if not given.")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the items already in the checkpoint journal with the same input_sequence.")
+    parser.add_argument("--overwrite_checkpoint", action="store_true",
+                        help="start again from an empty journal when not resuming, even if the journal has items.")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="number of processes executing the candidate sqls when voting.")
 
     opt = parser.parse_args()
 
     return opt
 
 
-def generate_reply(messages, n):
-    completions = openai.ChatCompletion.create(
+def generate_reply(messages, n, attempt=0):
+    completions = create_chat_completion(
+        attempt=attempt,
         model="gpt-3.5-turbo",
         messages=messages,
         n=n
@@ -71,129 +89,158 @@ def generate_reply(messages, n):
     return all_p_sqls
 
 
-def replace_cur_year(query: str) -> str:
-    return re.sub(
-        "YEAR\s*\(\s*CURDATE\s*\(\s*\)\s*\)\s*", "2020", query, flags=re.IGNORECASE
-    )
-
-
-def get_cursor_from_path(sqlite_path: str):
-    try:
-        if not os.path.exists(sqlite_path):
-            print("Openning a new connection %s" % sqlite_path)
-        connection = sqlite3.connect(sqlite_path)
-    except Exception as e:
-        print(sqlite_path)
-        raise e
-    connection.text_factory = lambda b: b.decode(errors="ignore")
-    cursor = connection.cursor()
-    return cursor
-
-
-def exec_on_db_(sqlite_path: str, query: str):
-    query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
-    try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
-        return "result", result
-    except Exception as e:
-        cursor.close()
-        cursor.connection.close()
-        return "exception", e
-
-
 def is_valid(sql, db_path):
-    flag, _ = exec_on_db_(db_path, sql)
-    if flag == "exception":
-        return 0
-    else:
+    if is_valid_sql(sql, db_path):
         return 1
+    else:
+        return 0
+
+
+def generate_sql(item, db_dir):
+    for j in range(5):
+        messages = []
+        messages = chat_prompt.copy()
+        input = item['input_sequence']
+        messages.append({"role": "user", "content": input})
+        p_sql = generate_reply(messages, 1, j)[0]
+        p_sql = 'SELECT ' + p_sql
+        p_sql = p_sql.replace("SELECT SELECT", "SELECT")
+        p_sql = fix_select_column(p_sql)
+        p_sql = p_sql.replace("> =", ">=").replace("< =", "<=").replace("! =", "!=")
+        print(f'p_sql: {p_sql}')
+        if is_valid(p_sql, db_dir):
+            break
+        else:
+            print(f're_id: {j} p_sql: {p_sql} exec error...')
+            time.sleep(0.5)
+            if j < 4:
+                print(f'generate again')
+    return [p_sql]
+
+
+def generate_sqls(item, db_dir, n):
+    # keep the valid candidates of every attempt and only ask for the missing ones
+    valid_p_sqls = []
+    p_sqls = []
+    for j in range(5):
+        messages = []
+        messages = chat_prompt.copy()
+        input = item['input_sequence']
+        messages.append({"role": "user", "content": input})
+        reply = None
+        while reply is None:
+            try:
+                reply = generate_reply(messages, n - len(valid_p_sqls), j)
+            except Exception as e:
+                print(e)
+                print(f"api error, wait for 3 seconds and retry...")
+                time.sleep(3)
+                pass
+        p_sqls = reply
+        temp = []
+        for p_sql in p_sqls:
+            p_sql = 'SELECT ' + p_sql
+            p_sql = p_sql.replace("SELECT SELECT", "SELECT")
+            try:
+                p_sql = fix_select_column(p_sql)
+            except:
+                print(f"fix_select_column err, p_sql: {p_sql}")
+                pass
+            p_sql = p_sql.replace("> =", ">=").replace("< =", "<=").replace("! =", "!=")
+            p_sql = p_sql.replace("\n", " ")
+            while "  " in p_sql:
+                p_sql = p_sql.replace("  ", " ")
+            temp.append(p_sql)
+        p_sqls = temp
+        valid_p_sqls.extend(p_sql for p_sql in p_sqls if is_valid(p_sql, db_dir))
+        if len(valid_p_sqls) == n:
+            break
+        else:
+            print(f're_id: {j} {n - len(valid_p_sqls)} of {n} p_sqls exec error...')
+            time.sleep(0.5)
+            if j < 4:
+                print(f'generate again')
+    # invalid candidates never win the vote, they are only kept when no candidate is valid
+    return valid_p_sqls if valid_p_sqls else p_sqls
+
+
+# the checkpoint journal has one line {"index", "db_id", "question", "input_hash", "p_sqls"} per
+# finished item, the last line of an index wins
+def get_input_hash(item):
+    return hashlib.sha256(item['input_sequence'].encode('utf-8')).hexdigest()
+
+
+def load_checkpoint(checkpoint_path):
+    results = {}
+    if not os.path.exists(checkpoint_path):
+        return results
+    with open(checkpoint_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be cut off by a crash, the item is generated again
+                continue
+            results[result['index']] = result
+    return results
+
+
+def truncate_partial_line(checkpoint_path):
+    # drop a line cut off by a crash, so that the next item does not get appended to it
+    if not os.path.exists(checkpoint_path):
+        return
+    with open(checkpoint_path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
 
 
 if __name__ == '__main__':
     opt = parse_option()
     print(opt)
-    with open(opt.input_dataset_path) as f:
-        data = json.load(f)
-    results = []
-    p_sql_final = []
-    if not opt.self_consistent:
-        for i, item in enumerate(data):
-            print("id", i)
+    configure_completion_cache(opt.completion_cache_path, opt.completion_cache_ttl,
+                               opt.completion_cache_max_mb * 1024 * 1024 if opt.completion_cache_max_mb else None)
+    checkpoint_path = opt.checkpoint_path or opt.output_dataset_path + '.checkpoint.jsonl'
+    if opt.resume:
+        truncate_partial_line(checkpoint_path)
+    elif os.path.exists(checkpoint_path) and os.path.getsize(checkpoint_path) > 0 and not opt.overwrite_checkpoint:
+        raise SystemExit(f'{checkpoint_path} already has generated items, '
+                         f'pass --resume to continue it or --overwrite_checkpoint to start again')
+    results = load_checkpoint(checkpoint_path) if opt.resume else {}
+    if results:
+        print(f'resume from {checkpoint_path}: {len(results)} items finished')
+
+    # generate the candidate sqls of the unfinished items, each item is appended to the journal once done
+    num_items = 0
+    with open(checkpoint_path, 'a' if opt.resume else 'w') as checkpoint:
+        for i, item in enumerate(tqdm(read_dataset(opt.input_dataset_path))):
+            num_items += 1
+            input_hash = get_input_hash(item)
+            # an item whose prompt changed since it was journaled is generated again
+            if i in results and results[i].get('input_hash') == input_hash:
+                continue
             db_dir = opt.db_dir + '/' + item['db_id'] + '/' + item['db_id'] + '.sqlite'
-            for j in range(5):
-                messages = []
-                messages = chat_prompt.copy()
-                input = item['input_sequence']
-                messages.append({"role": "user", "content": input})
-                p_sql = generate_reply(messages, 1)[0]
-                p_sql = 'SELECT ' + p_sql
-                p_sql = p_sql.replace("SELECT SELECT", "SELECT")
-                p_sql = fix_select_column(p_sql)
-                p_sql = p_sql.replace("> =", ">=").replace("< =", "<=").replace("! =", "!=")
-                print(f'p_sql: {p_sql}')
-                if is_valid(p_sql, db_dir):
-                    break
-                else:
-                    print(f're_id: {j} p_sql: {p_sql} exec error...')
-                    time.sleep(0.5)
-                    if j < 4:
-                        print(f'generate again')
-            p_sql_final.append(p_sql)
-            print(p_sql_final)
+            if opt.self_consistent:
+                p_sqls = generate_sqls(item, db_dir, opt.n)
+            else:
+                print("id", i)
+                p_sqls = generate_sql(item, db_dir)
+            result = {'index': i, 'db_id': item['db_id'], 'question': item['question'], 'input_hash': input_hash,
+                      'p_sqls': p_sqls}
+            checkpoint.write(json.dumps(result) + '\n')
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            results[i] = result
+
+    # vote among the first n candidates of each item by their execution results
+    results = [results[i] for i in range(num_items)]
+    if opt.self_consistent:
+        db_paths = [f"{opt.db_dir}/{result['db_id']}/{result['db_id']}" for result in results]
+        p_sqls = choose_sqls([result['p_sqls'][:opt.n] for result in results], db_paths, opt.num_workers)
     else:
-        for i, item in enumerate(tqdm(data)):
-            db_dir = opt.db_dir + '/' + item['db_id'] + '/' + item['db_id'] + '.sqlite'
-            p_sqls = []
-            for j in range(5):
-                messages = []
-                messages = chat_prompt.copy()
-                input = item['input_sequence']
-                messages.append({"role": "user", "content": input})
-                reply = None
-                while reply is None:
-                    try:
-                        reply = generate_reply(messages, opt.n)
-                    except Exception as e:
-                        print(e)
-                        print(f"api error, wait for 3 seconds and retry...")
-                        time.sleep(3)
-                        pass
-                p_sqls = reply
-                temp = []
-                for p_sql in p_sqls:
-                    p_sql = 'SELECT ' + p_sql
-                    p_sql = p_sql.replace("SELECT SELECT", "SELECT")
-                    try:
-                        p_sql = fix_select_column(p_sql)
-                    except:
-                        print(f"fix_select_column err, p_sql: {p_sql}")
-                        pass
-                    p_sql = p_sql.replace("> =", ">=").replace("< =", "<=").replace("! =", "!=")
-                    p_sql = p_sql.replace("\n", " ")
-                    while "  " in p_sql:
-                        p_sql = p_sql.replace("  ", " ")
-                    temp.append(p_sql)
-                p_sqls = temp
-                if is_valid(p_sqls[0], db_dir):
-                    break
-                else:
-                    print(f're_id: {j} p_sql: {p_sqls[0]} exec error...')
-                    time.sleep(0.5)
-                    if j < 4:
-                        print(f'generate again')
-            result = {}
-            result['db_id'] = item['db_id']
-            result['question'] = item['question']
-            result['p_sqls'] = []
-            for sql in p_sqls:
-                result['p_sqls'].append(sql)
-            results.append(result)
-            # time.sleep(1)
-        p_sql_final = get_sqls(results, opt.n, opt.db_dir)
+        p_sqls = [result['p_sqls'][0] for result in results]
     with open(opt.output_dataset_path, 'w') as f:
-        for sql in p_sql_final:
-            print(sql, file=f)
+        for p_sql in p_sqls:
+            print(p_sql, file=f)
+    # the predictions are written, a later run starts from an empty journal
+    os.remove(checkpoint_path)
@@ -5,17 +5,24 @@ import random
 import re
 import sqlite3
 import threading
-from collections import defaultdict
+import time
+from collections import defaultdict, OrderedDict, Counter
 from itertools import product
+from multiprocessing import Pool
 from typing import Tuple, Any, List, Set
 import sqlparse
 import tqdm
 
+import sqlite_pool
+from sqlite_pool import decode_text, execute_with_limits
+
 # from third_party.test_suite.exec_eval import eval_exec_match
 # from third_party.test_suite.parse import remove_distinct
 
 threadLock = threading.Lock()
 TIMEOUT = 60
+# queries returning more rows than this are given up, no limit if None
+MAX_ROWS = None
 EXEC_TMP_DIR = os.path.join(os.path.dirname(__file__), "tmp")
 
 
@@ -121,48 +128,44 @@ def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -
     return False
 
 
+# order-insensitive fingerprint of a denotation: the hash of the sorted multiset of its unordered rows
+# (rows are reduced to their sorted value hashes, which keeps the work in C).
+# two denotations which are equivalent under result_eq (with any row and column order)
+# always get the same fingerprint, so only denotations with equal fingerprints need comparing
+def get_denotation_hash(result: List[Tuple]) -> int:
+    return hash(tuple(sorted(hash(tuple(sorted(map(hash, row)))) for row in result)))
+
+
+# same as result_eq(result1, result2, False) for denotations with equal fingerprints,
+# the column permutation search only runs when the rows do not already match in their column order
+def denotation_eq(result1: List[Tuple], result2: List[Tuple]) -> bool:
+    if result1 is result2 or multiset_eq(result1, result2):
+        return True
+    return result_eq(result1, result2, False)
+
+
 def replace_cur_year(query: str) -> str:
     return re.sub(
         "YEAR\s*\(\s*CURDATE\s*\(\s*\)\s*\)\s*", "2020", query, flags=re.IGNORECASE
     )
 
 
-# get the database cursor for a sqlite database path
-def get_cursor_from_path(sqlite_path: str):
-    try:
-        if not os.path.exists(sqlite_path):
-            print("Openning a new connection %s" % sqlite_path)
-        connection = sqlite3.connect(sqlite_path)
-    except Exception as e:
-        print(sqlite_path)
-        raise e
-    connection.text_factory = lambda b: b.decode(errors="ignore")
-    cursor = connection.cursor()
-    return cursor
-
-
-async def exec_on_db_(sqlite_path: str, query: str) -> Tuple[str, Any]:
+async def exec_on_db_(sqlite_path: str, query: str, timeout: float = TIMEOUT,
+                      max_rows: int = MAX_ROWS) -> Tuple[str, Any]:
     query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
     try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
-        return "result", result
+        with sqlite_pool.connection_pool.connection(sqlite_path, decode_text) as connection:
+            return "result", execute_with_limits(connection, query, timeout, max_rows)
     except Exception as e:
-        cursor.close()
-        cursor.connection.close()
         return "exception", e
 
 
+# the timeout is enforced inside sqlite, asyncio.wait_for could not interrupt the blocking call
 async def exec_on_db(
-        sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT
+        sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT, max_rows: int = MAX_ROWS
 ) -> Tuple[str, Any]:
     try:
-        return await asyncio.wait_for(exec_on_db_(sqlite_path, query), timeout)
-    except asyncio.TimeoutError:
-        return ('exception', TimeoutError)
+        return await exec_on_db_(sqlite_path, query, timeout, max_rows)
     except Exception as e:
         return ("exception", e)
 
@@ -208,47 +211,112 @@ def get_exec_output(
         return flag, sql_denotation
 
 
-def get_sqls(results, select_number, db_dir):
-    db_ids = []
+def get_sqls(results, select_number, db_dir, num_workers=1):
+    db_paths = []
     all_p_sqls = []
     for item in results:
-        p_sqls = []
-        db_ids.append(item['db_id'])
-        for i, x in enumerate(item['p_sqls']):
-            p_sqls.append(x)
-            if i+1 == select_number:
-                break
-        all_p_sqls.append(p_sqls)
-    chosen_p_sqls = []
-    for i, db_id in enumerate(tqdm.tqdm(db_ids)):
-        p_sqls = all_p_sqls[i]
-        db_path = f"{db_dir}/{db_id}/{db_id}"
-        cluster_sql_list = []
-        map_sql2denotation = {}
-        for sql in p_sqls:
-            flag, denotation = get_exec_output(
-                db_path,
-                sql,
-            )
-            if flag == "exception":
-                continue
-            map_sql2denotation[sql] = denotation
-            denotation_match = False
-
-            for id, cluster in enumerate(cluster_sql_list):
-                center_sql = cluster[0]
-                if result_eq(map_sql2denotation[center_sql], denotation, False):
-                    cluster_sql_list[id].append(sql)
-                    denotation_match = True
-                    break
-            if not denotation_match:
-                cluster_sql_list.append([sql])
-        cluster_sql_list.sort(key=lambda x: len(x), reverse=True)
-        if not cluster_sql_list:
-            chosen_p_sqls.append(p_sqls[0])
-        else:
-            chosen_p_sqls.append(cluster_sql_list[0][0])
+        db_paths.append(f"{db_dir}/{item['db_id']}/{item['db_id']}")
+        all_p_sqls.append(item['p_sqls'][:select_number])
+    chosen_p_sqls = choose_sqls(all_p_sqls, db_paths, num_workers)
 
     print("save chosen sqls and results...")
 
     return chosen_p_sqls
+
+
+# the first sqlite file in the directory of ``db``, as picked by get_exec_output
+def get_db_file(db: str):
+    db_dir = os.path.dirname(db)
+    for basename in os.listdir(db_dir):
+        if ".sqlite" in basename:
+            return os.path.join(db_dir, basename)
+    return None
+
+
+# execute every candidate sql of one question on the pooled connections of its database,
+# same post-processing and (flag, denotation) outputs as get_exec_output
+def get_exec_outputs(db: str, sqls: List[str], keep_distinct: bool = False,
+                     timeout: float = TIMEOUT, max_rows: int = MAX_ROWS):
+    db_file = get_db_file(db)
+    outputs = {}
+    for sql in sqls:
+        if sql in outputs:
+            continue
+        query = postprocess(sql)
+        if not keep_distinct:
+            try:
+                query = remove_distinct(query)
+            except Exception as e:
+                outputs[sql] = ("exception", [])
+                continue
+        if db_file is None:
+            outputs[sql] = ("exception", [])
+            continue
+        try:
+            with sqlite_pool.connection_pool.connection(db_file, decode_text) as connection:
+                outputs[sql] = ("result", execute_with_limits(connection, replace_cur_year(query), timeout, max_rows))
+        except Exception as e:
+            outputs[sql] = ("exception", e)
+    return [outputs[sql] for sql in sqls]
+
+
+# vote among the candidate sqls of one question:
+# cluster them by execution result and return the first sql of the largest cluster
+def choose_sql(p_sqls, db_path):
+    cluster_sql_list = []
+    map_sql2denotation = {}
+    # denotation fingerprint -> ids of the clusters whose center has it, in creation order
+    map_hash2cluster_ids = defaultdict(list)
+    map_sql2hash = {}
+    for sql, (flag, denotation) in zip(p_sqls, get_exec_outputs(db_path, p_sqls)):
+        if flag == "exception":
+            continue
+        map_sql2denotation[sql] = denotation
+        if sql not in map_sql2hash:
+            map_sql2hash[sql] = get_denotation_hash(denotation)
+        denotation_hash = map_sql2hash[sql]
+        denotation_match = False
+
+        for id in map_hash2cluster_ids[denotation_hash]:
+            center_sql = cluster_sql_list[id][0]
+            if denotation_eq(map_sql2denotation[center_sql], denotation):
+                cluster_sql_list[id].append(sql)
+                denotation_match = True
+                break
+        if not denotation_match:
+            map_hash2cluster_ids[denotation_hash].append(len(cluster_sql_list))
+            cluster_sql_list.append([sql])
+    cluster_sql_list.sort(key=lambda x: len(x), reverse=True)
+    if not cluster_sql_list:
+        return p_sqls[0]
+    else:
+        return cluster_sql_list[0][0]
+
+
+def choose_group(group):
+    return [(idx, choose_sql(p_sqls, db_path)) for idx, p_sqls, db_path in group]
+
+
+# vote for every question, spreading the questions over ``num_workers`` processes
+def choose_sqls(all_p_sqls, db_paths, num_workers=1):
+    if num_workers <= 1:
+        return [choose_sql(p_sqls, db_path) for p_sqls, db_path in tqdm.tqdm(zip(all_p_sqls, db_paths), total=len(db_paths))]
+
+    # group questions by database so that each worker reuses its connections,
+    # and split large groups so that a dataset with few databases still uses every worker
+    by_db = OrderedDict()
+    for idx, (p_sqls, db_path) in enumerate(zip(all_p_sqls, db_paths)):
+        by_db.setdefault(db_path, []).append((idx, p_sqls, db_path))
+    chunk_size = max(1, len(db_paths) // (num_workers * 4))
+    groups = [group[i:i + chunk_size] for group in by_db.values() for i in range(0, len(group), chunk_size)]
+    # schedule the largest groups first to balance the workers
+    groups.sort(key=len, reverse=True)
+
+    chosen_p_sqls = [None] * len(db_paths)
+    with Pool(num_workers) as pool:
+        with tqdm.tqdm(total=len(chosen_p_sqls)) as pbar:
+            for results in pool.imap_unordered(choose_group, groups):
+                for idx, p_sql in results:
+                    chosen_p_sqls[idx] = p_sql
+                pbar.update(len(results))
+    return chosen_p_sqls
@@ -0,0 +1,203 @@
+"""
+ Incremental refresh of the value indexes of a database directory after its files changed.
+
+ The state of every database (file signature, and per table its schema, row count and largest
+ rowid) is recorded under ``state_dir``. A database whose signature (mtime and size of the file and
+ of its write-ahead log) is unchanged is skipped; otherwise the tables whose state differs are
+ found, and only the picklists, profiles, value sketches and fts indexes of their columns are
+ dropped or built again, the others being kept for the new file. A database without a recorded
+ state has all of its indexes refreshed, and ``--full`` refreshes every table of a changed database.
+
+ Updates which keep the row count and the largest rowid of a table are only seen with
+ ``--detect_in_place_updates``, which adds a digest of the rows to the state of every table and so
+ reads the whole of a changed database. With ``--watch`` the directory is checked again every few
+ seconds, and a database which ``PRAGMA data_version`` shows was written is checked even if its
+ signature did not change.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+from pathlib import Path
+
+from column_profile import configure_column_profiles
+from fts_index import configure_fts_index
+from picklist_cache import get_db_key, configure_picklist_cache
+from value_sketch import configure_value_sketches
+import sqlite_pool
+from sqlite_pool import get_db_signature, atomic_write
+
+
+def get_table_digest(conn, table_name: str) -> str:
+    """Digest of the rows of ``table_name`` in storage order, which tells in-place updates apart."""
+    digest = hashlib.blake2b(digest_size=16)
+    cursor = conn.execute("SELECT * FROM `{}`".format(table_name))
+    for rows in iter(lambda: cursor.fetchmany(10000), []):
+        digest.update(repr(rows).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_table_states(db_path: str, digests: bool = False) -> dict:
+    states = {}
+    with sqlite_pool.connection_pool.connection(db_path, text_factory=bytes) as conn:
+        for table_name, table_sql in conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'").fetchall():
+            table_name, table_sql = table_name.decode(), table_sql.decode()
+            columns = [row[1].decode() for row in conn.execute("PRAGMA table_info(`{}`)".format(table_name))]
+            try:
+                num_rows, max_rowid = conn.execute(
+                    "SELECT COUNT(*), MAX(rowid) FROM `{}`".format(table_name)).fetchone()
+            except sqlite3.OperationalError:
+                # WITHOUT ROWID table
+                num_rows = conn.execute("SELECT COUNT(*) FROM `{}`".format(table_name)).fetchone()[0]
+                max_rowid = None
+            states[table_name] = {"sql": table_sql, "columns": columns,
+                                  "num_rows": num_rows, "max_rowid": max_rowid}
+            if digests:
+                states[table_name]["digest"] = get_table_digest(conn, table_name)
+    return states
+
+
+def get_changed_columns(old_states: dict, new_states: dict) -> list:
+    """(table, column) pairs of the tables which were added, dropped or changed, named as before and after."""
+    changed_columns = []
+    for table_name in sorted(set(old_states) | set(new_states)):
+        old_state, new_state = old_states.get(table_name), new_states.get(table_name)
+        # the digests are only compared if both states have one
+        if old_state is not None and new_state is not None and ("digest" in old_state) != ("digest" in new_state):
+            old_state, new_state = [{key: value for key, value in state.items() if key != "digest"}
+                                    for state in (old_state, new_state)]
+        if old_state == new_state:
+            continue
+        for state in (old_state, new_state):
+            if state is not None:
+                changed_columns.extend((table_name, column_name) for column_name in state["columns"]
+                                       if (table_name, column_name) not in changed_columns)
+    return changed_columns
+
+
+class DatabaseWatcher(object):
+    """
+    Tells which databases were written since the last check: by replacing the file or writing to it
+    (its signature) or by another connection (``PRAGMA data_version`` of a connection kept open).
+    """
+
+    def __init__(self) -> None:
+        # db path -> (signature, connection, data version)
+        self.databases = {}
+
+    def changed(self, db_path: str):
+        """None if ``db_path`` was not written, else "signature" or "data_version" (signature unchanged)."""
+        db_path = os.path.abspath(db_path)
+        signature = get_db_signature(db_path)
+        change = "signature"
+        if db_path in self.databases:
+            old_signature, conn, data_version = self.databases[db_path]
+            if old_signature == signature:
+                if conn.execute("PRAGMA data_version").fetchone()[0] == data_version:
+                    return None
+                change = "data_version"
+            conn.close()
+        conn = sqlite3.connect(Path(db_path).as_uri() + "?mode=ro", uri=True)
+        self.databases[db_path] = (signature, conn, conn.execute("PRAGMA data_version").fetchone()[0])
+        return change
+
+
+class IndexRefresher(object):
+    def __init__(self, state_dir: str, stores: list, full: bool = False, digests: bool = False) -> None:
+        self.state_dir = state_dir
+        # every store has a ``refresh(db_path, changed_columns, since_signature)'' method, the
+        # picklists come first since the sketches are built from them
+        self.stores = stores
+        self.full = full
+        self.digests = digests
+
+    def state_path(self, db_path: str) -> str:
+        return os.path.join(self.state_dir, get_db_key(db_path) + ".json")
+
+    def refresh(self, db_path: str, force: bool = False):
+        """
+        Refresh the indexes of ``db_path``, returns the changed columns (None for all). The tables are
+        only compared if the signature changed, or if ``force`` is set (the database was written).
+        """
+        signature = get_db_signature(db_path)
+        old = None
+        if os.path.exists(self.state_path(db_path)):
+            with open(self.state_path(db_path)) as f:
+                old = json.load(f)
+        if old is not None and old["signature"] == signature and not force:
+            return []
+        if force:
+            # the pooled connections would not see a write which kept the signature
+            sqlite_pool.connection_pool.invalidate(db_path)
+
+        tables = get_table_states(db_path, self.digests)
+        if old is None:
+            changed_columns, since_signature = None, None
+        elif self.full:
+            changed_columns, since_signature = None, old["signature"]
+        else:
+            changed_columns, since_signature = get_changed_columns(old["tables"], tables), old["signature"]
+        for store in self.stores:
+            store.refresh(db_path, changed_columns, since_signature)
+        os.makedirs(self.state_dir, exist_ok=True)
+        state = {"db_path": os.path.abspath(db_path), "signature": signature, "tables": tables}
+        atomic_write(self.state_path(db_path), json.dumps(state).encode("utf-8"))
+        return changed_columns
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for refreshing the value indexes")
+    parser.add_argument("--db_dir", type=str, default="./data/spider/database")
+    parser.add_argument("--db_ids", type=str, nargs="*", default=None,
+                        help="databases to refresh, every database of db_dir if not given.")
+    parser.add_argument("--state_dir", type=str, required=True,
+                        help="directory of the recorded database states.")
+    parser.add_argument("--picklist_cache_dir", type=str, default=None)
+    parser.add_argument("--column_profile_dir", type=str, default=None)
+    parser.add_argument("--value_sketch_dir", type=str, default=None)
+    parser.add_argument("--fts_sidecar_dir", type=str, default=None)
+    parser.add_argument("--full", action="store_true",
+                        help="refresh every table of a changed database.")
+    parser.add_argument("--detect_in_place_updates", action="store_true",
+                        help="compare a digest of the rows of every table, which reads the whole of a changed "
+                             "database, to see the updates keeping the row count and the largest rowid.")
+    parser.add_argument("--watch", type=float, default=None,
+                        help="seconds between two checks of the directory, a single check if not given.")
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    # the stores are the module-level ones, which the sketches and fts indexes are built through
+    stores = [
+        configure_picklist_cache(opt.picklist_cache_dir),
+        configure_column_profiles(opt.column_profile_dir),
+        configure_value_sketches(opt.value_sketch_dir),
+        configure_fts_index(opt.fts_sidecar_dir),
+    ]
+    refresher = IndexRefresher(opt.state_dir, stores, opt.full, opt.detect_in_place_updates)
+    watcher = DatabaseWatcher()
+    while True:
+        for db_id in opt.db_ids or sorted(os.listdir(opt.db_dir)):
+            db_path = os.path.join(opt.db_dir, db_id, db_id + ".sqlite")
+            if not os.path.exists(db_path):
+                continue
+            change = watcher.changed(db_path)
+            if change is None:
+                continue
+            changed_columns = refresher.refresh(db_path, force=change == "data_version")
+            if changed_columns is None:
+                print(f"{db_id}: refreshed every column")
+            elif changed_columns:
+                print(f"{db_id}: refreshed {len(changed_columns)} columns of "
+                      f"{len({table_name for table_name, _ in changed_columns})} tables")
+        if opt.watch is None:
+            break
+        time.sleep(opt.watch)
@@ -0,0 +1,155 @@
+"""
+ Chat completion clients.
+
+ Requests are sent with ``openai.ChatCompletion.acreate`` under a concurrency limit and two token
+ buckets (requests per minute and tokens per minute); failed requests are retried with exponential
+ backoff and full jitter. ``ordered_map`` runs a coroutine over a stream of items with a bounded
+ number in flight and yields the results in input order. Both clients answer from the completion cache
+ when one is configured.
+"""
+
+import time
+import random
+import asyncio
+from collections import deque
+
+import openai
+
+import completion_cache
+
+
+def get_cached_completion(request: dict, attempt: int):
+    if completion_cache.completion_cache is None:
+        return None
+    response = completion_cache.completion_cache.get(request, attempt)
+    if response is None:
+        return None
+    return openai.util.convert_to_openai_object(response)
+
+
+def put_cached_completion(request: dict, attempt: int, completions) -> None:
+    if completion_cache.completion_cache is not None:
+        completion_cache.completion_cache.put(request, completions.to_dict_recursive(), attempt)
+
+
+def create_chat_completion(attempt: int = 0, **kwargs):
+    """
+    Synchronous ``openai.ChatCompletion.create`` through the completion cache,
+    ``attempt`` numbers the requests a caller repeats on purpose.
+    """
+    completions = get_cached_completion(kwargs, attempt)
+    if completions is None:
+        completions = openai.ChatCompletion.create(**kwargs)
+        put_cached_completion(kwargs, attempt, completions)
+    return completions
+
+
+def estimate_tokens(messages) -> int:
+    # about four characters per token, plus the per-message overhead of the chat format
+    return sum(len(message["content"]) // 4 + 4 for message in messages)
+
+
+class TokenBucket(object):
+    def __init__(self, capacity_per_minute: float) -> None:
+        self.capacity = capacity_per_minute
+        self.rate = capacity_per_minute / 60.0 if capacity_per_minute else None
+        self.tokens = capacity_per_minute
+        self.updated = time.monotonic()
+        # created on first use, inside the event loop which runs the requests
+        self.lock = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float) -> None:
+        if self.rate is None:
+            return
+        # a request larger than the bucket still goes through once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # waiters are served first come first served, as the lock is held while sleeping
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Take ``amount`` more tokens (or give them back if negative) after the fact."""
+        if self.rate is not None:
+            self.tokens -= amount
+
+
+class AsyncChatClient(object):
+    def __init__(self, max_concurrency: int = 8, requests_per_minute: float = 3500,
+                 tokens_per_minute: float = 90000, max_retries: int = 8, base_delay: float = 1.0,
+                 max_delay: float = 60.0, completion_tokens: int = 256) -> None:
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # expected length of one completion, used to reserve tokens before the request is sent
+        self.completion_tokens = completion_tokens
+
+    def backoff(self, retries: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retries))
+
+    async def create(self, attempt: int = 0, **kwargs):
+        completions = get_cached_completion(kwargs, attempt)
+        if completions is not None:
+            return completions
+        reserved = estimate_tokens(kwargs["messages"]) + self.completion_tokens * kwargs.get("n", 1)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        retries = 0
+        while True:
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(reserved)
+            try:
+                async with self.semaphore:
+                    completions = await openai.ChatCompletion.acreate(**kwargs)
+            except (openai.error.InvalidRequestError, openai.error.AuthenticationError):
+                raise
+            except Exception as e:
+                if retries >= self.max_retries:
+                    raise
+                delay = self.backoff(retries)
+                retries += 1
+                print(f"api error: {e}, wait for {delay:.1f} seconds and retry...")
+                await asyncio.sleep(delay)
+                continue
+
+            usage = completions.get("usage")
+            if usage is not None:
+                self.token_bucket.adjust(usage["total_tokens"] - reserved)
+            put_cached_completion(kwargs, attempt, completions)
+            return completions
+
+
+def ordered_map(coroutine_function, items, window: int):
+    """
+    Run ``coroutine_function`` on every item with at most ``window`` calls in flight,
+    yielding the results lazily and in the order of ``items``.
+    """
+    loop = asyncio.new_event_loop()
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(loop.create_task(coroutine_function(item)))
+            if len(pending) >= window:
+                yield loop.run_until_complete(pending.popleft())
+        while pending:
+            yield loop.run_until_complete(pending.popleft())
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
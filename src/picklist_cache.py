@@ -0,0 +1,216 @@
+"""
+ Persistent store of column picklists (the distinct text values of a column).
+
+ Picklists are written once per (database file, table, column) under ``cache_dir``, so repeated
+ runs never query SQLite for values they have already seen. Every file records the signature (mtime
+ and size) of the database it was read from: a stale file is ignored and replaced by an atomic
+ rename, so concurrent readers and writers never see a partial or missing entry. Recently used
+ picklists are also kept in memory, bounded by ``memory_budget`` bytes with LRU eviction.
+"""
+
+import os
+import pickle
+import shutil
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+
+from sqlite_pool import get_db_signature, atomic_write
+
+
+def get_db_key(db_path: str) -> str:
+    return hashlib.sha1(os.path.abspath(db_path).encode("utf-8")).hexdigest()
+
+
+def get_column_key(table_name: str, column_name: str) -> str:
+    return hashlib.sha1("{}\t{}".format(table_name, column_name).encode("utf-8")).hexdigest()
+
+
+def get_column_keys(columns) -> set:
+    """Keys of the (table, column) pairs, named as in the database or lower cased (as in tables.json)."""
+    return {get_column_key(t, c) for table_name, column_name in columns
+            for t, c in ((table_name, column_name), (table_name.lower(), column_name.lower()))}
+
+
+def is_changed_column(table_name: str, column_name: str, changed_columns) -> bool:
+    return changed_columns is None or (table_name.lower(), column_name.lower()) in \
+        {(t.lower(), c.lower()) for t, c in changed_columns}
+
+
+def is_current_entry(entry_signature: list, signature: list, since_signature: list, changed: bool) -> bool:
+    """
+    Whether an entry stamped with ``entry_signature`` is valid for the file of ``signature``: a changed
+    one is not if the file was written without changing its signature (``since_signature`` is it).
+    """
+    return entry_signature == signature and (since_signature != signature or not changed)
+
+
+def remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_dir(path: str) -> None:
+    # renamed away first, so that no other process ever sees a half-deleted directory
+    trash_path = "{}.{}.{}.removed".format(path, os.getpid(), threading.get_ident())
+    try:
+        os.rename(path, trash_path)
+    except FileNotFoundError:
+        return
+    shutil.rmtree(trash_path, ignore_errors=True)
+
+
+class PicklistStore(object):
+    def __init__(self, cache_dir: str = None, memory_budget: int = 256 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.lock = threading.RLock()
+
+    def get(self, db_path: str, table_name: str, column_name: str, fetch) -> list:
+        signature = get_db_signature(db_path)
+        key = (os.path.abspath(db_path), table_name, column_name)
+        with self.lock:
+            if key in self.memory:
+                entry_signature, picklist, _ = self.memory[key]
+                if entry_signature == signature:
+                    self.memory.move_to_end(key)
+                    return picklist
+                self._forget(key)
+
+        picklist = None
+        column_path = self._column_path(db_path, table_name, column_name)
+        if column_path is not None:
+            entry = self._read(column_path)
+            if entry is not None and entry[0] == signature:
+                picklist, size = entry[1], entry[2]
+        if picklist is None:
+            picklist = fetch(table_name, column_name, db_path)
+            data = pickle.dumps((signature, picklist), protocol=pickle.HIGHEST_PROTOCOL)
+            size = len(data)
+            if column_path is not None:
+                os.makedirs(os.path.dirname(column_path), exist_ok=True)
+                atomic_write(column_path, data)
+
+        with self.lock:
+            self._remember(key, signature, picklist, size)
+        return picklist
+
+    def invalidate(self, db_path: str = None) -> None:
+        """Drop the cached picklists of ``db_path``, or of every database if it is None."""
+        with self.lock:
+            if db_path is None:
+                self.memory.clear()
+                self.memory_used = 0
+                if self.cache_dir is not None:
+                    remove_dir(self.cache_dir)
+                return
+
+            abs_db_path = os.path.abspath(db_path)
+            for key in [key for key in self.memory if key[0] == abs_db_path]:
+                self._forget(key)
+            if self.cache_dir is not None:
+                remove_dir(os.path.join(self.cache_dir, get_db_key(db_path)))
+
+    def refresh(self, db_path: str, changed_columns=None, since_signature: list = None) -> None:
+        """
+        Make the picklists of ``db_path`` valid for its current file: the ones of ``changed_columns``
+        are dropped, the others are kept (stamped with the current signature) if they were cached for
+        the file of ``since_signature``. Every picklist is dropped if ``changed_columns`` is None.
+        ``since_signature`` is the current signature if the file was written without changing it.
+        """
+        signature = get_db_signature(db_path)
+        abs_db_path = os.path.abspath(db_path)
+        with self.lock:
+            for key in [key for key in self.memory if key[0] == abs_db_path]:
+                entry_signature, picklist, size = self.memory[key]
+                if is_current_entry(entry_signature, signature, since_signature,
+                                    is_changed_column(key[1], key[2], changed_columns)):
+                    continue
+                if entry_signature != since_signature or is_changed_column(key[1], key[2], changed_columns):
+                    self._forget(key)
+                else:
+                    self.memory[key] = (signature, picklist, size)
+
+            if self.cache_dir is None:
+                return
+            db_cache_dir = os.path.join(self.cache_dir, get_db_key(db_path))
+            if not os.path.isdir(db_cache_dir):
+                return
+            changed_keys = get_column_keys(changed_columns) if changed_columns is not None else None
+            for file_name in os.listdir(db_cache_dir):
+                column_path = os.path.join(db_cache_dir, file_name)
+                if not file_name.endswith(".pkl"):
+                    continue
+                entry = self._read(column_path)
+                if entry is None or is_current_entry(entry[0], signature, since_signature, changed_keys is None or
+                                                     os.path.splitext(file_name)[0] in changed_keys):
+                    continue
+                if changed_keys is None or entry[0] != since_signature or \
+                        os.path.splitext(file_name)[0] in changed_keys:
+                    remove_file(column_path)
+                else:
+                    atomic_write(column_path, pickle.dumps((signature, entry[1]), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _column_path(self, db_path: str, table_name: str, column_name: str):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, get_db_key(db_path), get_column_key(table_name, column_name) + ".pkl")
+
+    @staticmethod
+    def _read(column_path: str):
+        """(signature, picklist, size in bytes) of a cached file, None if there is none."""
+        try:
+            with open(column_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        entry = pickle.loads(data)
+        # files written before the signature was stored in them are stale
+        if not isinstance(entry, tuple):
+            return None
+        return entry[0], entry[1], len(data)
+
+    def _remember(self, key, signature, picklist, size) -> None:
+        if key in self.memory:
+            self._forget(key)
+        if size > self.memory_budget:
+            return
+        self.memory[key] = (signature, picklist, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_budget:
+            _, (_, _, evicted_size) = self.memory.popitem(last=False)
+            self.memory_used -= evicted_size
+
+    def _forget(self, key) -> None:
+        _, _, size = self.memory.pop(key)
+        self.memory_used -= size
+
+
+picklist_store = PicklistStore()
+
+
+def configure_picklist_cache(cache_dir: str = None, memory_budget: int = 256 * 1024 * 1024) -> PicklistStore:
+    global picklist_store
+    picklist_store = PicklistStore(cache_dir=cache_dir, memory_budget=memory_budget)
+    return picklist_store
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for the picklist cache")
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--invalidate", type=str, default=None,
+                        help="path of the sqlite file whose picklists are dropped, all databases if not given.")
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    PicklistStore(cache_dir=opt.cache_dir).invalidate(opt.invalidate)
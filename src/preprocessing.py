@@ -1,8 +1,17 @@
 import re
 import json
 import argparse
+from collections import OrderedDict
+from itertools import repeat
+from multiprocessing import Pool
 
 from bridge_content_encoder import get_database_matches
+from column_profile import configure_column_profiles, DEFAULT_SKIP_KINDS
+from dataset_io import read_dataset, write_dataset
+from fts_index import configure_fts_index
+from picklist_cache import configure_picklist_cache
+from schema_cache import compile_schemas, load_schemas
+from value_sketch import configure_value_sketches
 from sql_metadata import Parser
 from tqdm import tqdm
 
@@ -16,6 +25,8 @@ def parse_option():
 
     parser.add_argument('--mode', type=str, default="train")
     parser.add_argument('--table_path', type=str, default="./data/spider/tables.json")
+    parser.add_argument("--schema_cache_path", type=str, default=None,
+                        help="file caching the compiled schemas of table_path, compiled on every run if not given.")
     parser.add_argument('--input_dataset_path', type=str, default="./data/spider/train_spider.json",
                         help='''
                             options:
@@ -35,6 +46,28 @@ def parse_option():
     parser.add_argument("--target_type", type=str, default="sql",
                         help="sql or natsql.")
     parser.add_argument("--dataset_name", type=str, default="spider")
+    parser.add_argument("--picklist_cache_dir", type=str, default=None,
+                        help="directory of the persistent picklist cache, no persistence if not given.")
+    parser.add_argument("--picklist_memory_budget", type=int, default=256,
+                        help="memory budget (in MB) of the in-process picklist cache.")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="number of worker processes, examples of the same database go to the same worker.")
+    parser.add_argument("--column_profile_dir", type=str, default=None,
+                        help="directory of the persistent column profiles, no persistence if not given.")
+    parser.add_argument("--skip_column_kinds", type=str, nargs="*", default=list(DEFAULT_SKIP_KINDS),
+                        help="kinds of columns (empty, numeric, date, id, text) whose values are not matched, "
+                             "date and id columns are matched unless listed.")
+    parser.add_argument("--max_column_mb", type=int, default=64,
+                        help="size (in MB) of text values above which the picklist of a column is truncated.")
+    parser.add_argument("--fts_sidecar_dir", type=str, default=None,
+                        help="directory of the fts sidecar indexes of the databases (built on first use), "
+                             "picklists are matched if not given.")
+    parser.add_argument("--fts_max_candidates", type=int, default=100,
+                        help="number of values an fts sidecar returns per column and question.")
+    parser.add_argument("--value_sketch_dir", type=str, default=None,
+                        help="directory of the value sketches built by value_sketch.py, exact matching if not given.")
+    parser.add_argument("--value_sketch_top_k", type=int, default=20,
+                        help="number of values shortlisted per question span from a value sketch.")
 
     opt = parser.parse_args()
 
@@ -58,70 +91,7 @@ def get_db_contents(question, table_name_original, column_names_original, db_id,
 
 
 def get_db_schemas(all_db_infos, opt=None):
-    db_schemas = {}
-
-    for db in all_db_infos:
-        table_names_original = db["table_names_original"]
-        table_names = db["table_names"]
-        column_names_original = db["column_names_original"]
-        column_names = db["column_names"]
-        column_types = db["column_types"]
-
-        db_schemas[db["db_id"]] = {}
-
-        primary_keys, foreign_keys = [], []
-        # record primary keys
-        for pk_column_idx in db["primary_keys"]:
-            pk_table_name_original = table_names_original[column_names_original[pk_column_idx][0]]
-            pk_column_name_original = column_names_original[pk_column_idx][1]
-
-            primary_keys.append(
-                {
-                    "table_name_original": pk_table_name_original.lower(),
-                    "column_name_original": pk_column_name_original.lower()
-                }
-            )
-
-        db_schemas[db["db_id"]]["pk"] = primary_keys
-
-        # record foreign keys
-        for source_column_idx, target_column_idx in db["foreign_keys"]:
-            fk_source_table_name_original = table_names_original[column_names_original[source_column_idx][0]]
-            fk_source_column_name_original = column_names_original[source_column_idx][1]
-
-            fk_target_table_name_original = table_names_original[column_names_original[target_column_idx][0]]
-            fk_target_column_name_original = column_names_original[target_column_idx][1]
-
-            foreign_keys.append(
-                {
-                    "source_table_name_original": fk_source_table_name_original.lower(),
-                    "source_column_name_original": fk_source_column_name_original.lower(),
-                    "target_table_name_original": fk_target_table_name_original.lower(),
-                    "target_column_name_original": fk_target_column_name_original.lower(),
-                }
-            )
-        db_schemas[db["db_id"]]["fk"] = foreign_keys
-
-        db_schemas[db["db_id"]]["schema_items"] = []
-        for idx, table_name_original in enumerate(table_names_original):
-            column_names_original_list = []
-            column_names_list = []
-            column_types_list = []
-            for column_idx, (table_idx, column_name_original) in enumerate(column_names_original):
-                if idx == table_idx:
-                    column_names_original_list.append(column_name_original.lower())
-                    column_names_list.append(column_names[column_idx][1].lower())
-                    column_types_list.append(column_types[column_idx])
-
-            db_schemas[db["db_id"]]["schema_items"].append({
-                "table_name_original": table_name_original.lower(),
-                "table_name": table_names[idx].lower(),
-                "column_names": column_names_list,
-                "column_names_original": column_names_original_list,
-                "column_types": column_types_list
-            })
-
-    return db_schemas
+    return compile_schemas(all_db_infos)
 
 
 def normalization(sql):
@@ -275,159 +245,201 @@ def isFloat(string):
         return True
 
 
+def preprocess_data(natsql_data, data, db_schemas, opt):
+    if data[
+        'query'] == 'SELECT T1.company_name FROM Third_Party_Companies AS T1 JOIN Maintenance_Contracts AS T2 ON T1.company_id  =  T2.maintenance_contract_company_id JOIN Ref_Company_Types AS T3 ON T1.company_type_code  =  T3.company_type_code ORDER BY T2.contract_end_date DESC LIMIT 1':
+        data[
+            'query'] = 'SELECT T1.company_type FROM Third_Party_Companies AS T1 JOIN Maintenance_Contracts AS T2 ON T1.company_id  =  T2.maintenance_contract_company_id ORDER BY T2.contract_end_date DESC LIMIT 1'
+        data['query_toks'] = ['SELECT', 'T1.company_type', 'FROM', 'Third_Party_Companies', 'AS', 'T1', 'JOIN',
+                              'Maintenance_Contracts', 'AS', 'T2', 'ON', 'T1.company_id', '=',
+                              'T2.maintenance_contract_company_id', 'ORDER', 'BY', 'T2.contract_end_date',
+                              'DESC',
+                              'LIMIT', '1']
+        data['query_toks_no_value'] = ['select', 't1', '.', 'company_type', 'from', 'third_party_companies',
+                                       'as',
+                                       't1', 'join', 'maintenance_contracts', 'as', 't2', 'on', 't1', '.',
+                                       'company_id', '=', 't2', '.', 'maintenance_contract_company_id', 'order',
+                                       'by', 't2', '.', 'contract_end_date', 'desc', 'limit', 'value']
+        data['question'] = 'What is the type of the company who concluded its contracts most recently?'
+        data['question_toks'] = ['What', 'is', 'the', 'type', 'of', 'the', 'company', 'who', 'concluded', 'its',
+                                 'contracts', 'most', 'recently', '?']
+    if data['query'].startswith(
+            'SELECT T1.fname FROM student AS T1 JOIN lives_in AS T2 ON T1.stuid  =  T2.stuid WHERE T2.dormid IN'):
+        data['query'] = data['query'].replace('IN (SELECT T2.dormid)', 'IN (SELECT T3.dormid)')
+        index = data['query_toks'].index('(') + 2
+        assert data['query_toks'][index] == 'T2.dormid'
+        data['query_toks'][index] = 'T3.dormid'
+        index = data['query_toks_no_value'].index('(') + 2
+        assert data['query_toks_no_value'][index] == 't2'
+        data['query_toks_no_value'][index] = 't3'
+
+    question = data["question"].replace("\u2018", "'").replace("\u2019", "'").replace("\u201c", "'").replace(
+        "\u201d", "'").strip()
+    db_id = data["db_id"]
+
+    if opt.mode == "test":
+        sql, norm_sql, sql_skeleton = "", "", ""
+        sql_tokens = []
+
+        natsql, norm_natsql, natsql_skeleton = "", "", ""
+        natsql_used_columns, natsql_tokens = [], []
+    else:
+
+        sql = data["query"].strip()
+        norm_sql = normalization(sql).strip()
+        sql_skeleton = extract_skeleton(norm_sql, db_schemas[db_id]).strip()
+        sql_tokens = norm_sql.split()
+
+        if natsql_data is not None:
+            natsql = natsql_data["NatSQL"].strip()
+            norm_natsql = normalization(natsql).strip()
+            natsql_skeleton = extract_skeleton(norm_natsql, db_schemas[db_id]).strip()
+            natsql_used_columns = [token for token in norm_natsql.split() if "." in token and token != "@.@"]
+            natsql_tokens = []
+            for token in norm_natsql.split():
+                # split table_name_original.column_name_original
+                if "." in token:
+                    natsql_tokens.extend(token.split("."))
+                else:
+                    natsql_tokens.append(token)
+        else:
+            natsql, norm_natsql, natsql_skeleton = "", "", ""
+            natsql_used_columns, natsql_tokens = [], []
+
+    preprocessed_data = {}
+    preprocessed_data["question"] = question
+    preprocessed_data["db_id"] = db_id
+
+    preprocessed_data["sql"] = sql
+    preprocessed_data["norm_sql"] = norm_sql
+    preprocessed_data["sql_skeleton"] = sql_skeleton
+
+    preprocessed_data["natsql"] = natsql
+    preprocessed_data["norm_natsql"] = norm_natsql
+    preprocessed_data["natsql_skeleton"] = natsql_skeleton
+
+    # pk and fk are looked up by db_id in the compiled schemas
+    preprocessed_data["db_schema"] = []
+    preprocessed_data["table_labels"] = []
+    preprocessed_data["column_labels"] = []
+
+    # add database information (including table name, column name, ..., table_labels, and column labels)
+    for table in db_schemas[db_id]["schema_items"]:
+        db_contents = get_db_contents(
+            question,
+            table["table_name_original"],
+            table["column_names_original"],
+            db_id,
+            opt.db_path
+        )
+
+        preprocessed_data["db_schema"].append({
+            "table_name_original": table["table_name_original"],
+            "table_name": table["table_name"],
+            "column_names": table["column_names"],
+            "column_names_original": table["column_names_original"],
+            "column_types": table["column_types"],
+            "db_contents": db_contents
+        })
+
+        # extract table and column classification labels
+        if opt.target_type == "sql":
+            if table["table_name_original"] in sql_tokens:  # for used tables
+                preprocessed_data["table_labels"].append(1)
+                column_labels = []
+                for column_name_original in table["column_names_original"]:
+                    if column_name_original in sql_tokens or \
+                            table[
+                                "table_name_original"] + "." + column_name_original in sql_tokens:  # for used columns
+                        column_labels.append(1)
+                    else:
+                        column_labels.append(0)
+                preprocessed_data["column_labels"].append(column_labels)
+            else:  # for unused tables and their columns
+                preprocessed_data["table_labels"].append(0)
+                preprocessed_data["column_labels"].append([0 for _ in range(len(table["column_names_original"]))])
+        elif opt.target_type == "natsql":
+            if table["table_name_original"] in natsql_tokens:  # for used tables
+                preprocessed_data["table_labels"].append(1)
+                column_labels = []
+                for column_name_original in table["column_names_original"]:
+                    if table[
+                        "table_name_original"] + "." + column_name_original in natsql_used_columns:  # for used columns
+                        column_labels.append(1)
+                    else:
+                        column_labels.append(0)
+                preprocessed_data["column_labels"].append(column_labels)
+            else:
+                preprocessed_data["table_labels"].append(0)
+                preprocessed_data["column_labels"].append([0 for _ in range(len(table["column_names_original"]))])
+        else:
+            raise ValueError("target_type should be ``sql'' or ``natsql''")
+
+    return preprocessed_data
+
+
+# state of a worker process, set once by ``init_worker''
+worker_db_schemas, worker_opt = None, None
+
+
+def init_worker(db_schemas, opt):
+    global worker_db_schemas, worker_opt
+    worker_db_schemas, worker_opt = db_schemas, opt
+    configure_picklist_cache(opt.picklist_cache_dir, opt.picklist_memory_budget * 1024 * 1024)
+    configure_value_sketches(opt.value_sketch_dir, opt.value_sketch_top_k)
+    configure_fts_index(opt.fts_sidecar_dir, opt.fts_max_candidates)
+    configure_column_profiles(opt.column_profile_dir, opt.skip_column_kinds, opt.max_column_mb * 1024 * 1024)
+
+
+def preprocess_group(group):
+    return [(idx, preprocess_data(natsql_data, data, worker_db_schemas, worker_opt))
+            for idx, natsql_data, data in group]
+
+
+def preprocess_dataset_parallel(natsql_dataset, dataset, db_schemas, opt):
+    # group examples by database so that each worker keeps its picklist cache warm
+    groups = OrderedDict()
+    for idx, (natsql_data, data) in enumerate(zip(natsql_dataset, dataset)):
+        groups.setdefault(data["db_id"], []).append((idx, natsql_data, data))
+    # schedule the largest groups first to balance the workers
+    groups = sorted(groups.values(), key=len, reverse=True)
+
+    preprocessed_dataset = [None] * sum(len(group) for group in groups)
+    with Pool(opt.num_workers, initializer=init_worker, initargs=(db_schemas, opt)) as pool:
+        with tqdm(total=len(preprocessed_dataset)) as pbar:
+            for results in pool.imap_unordered(preprocess_group, groups):
+                for idx, preprocessed_data in results:
+                    preprocessed_dataset[idx] = preprocessed_data
+                pbar.update(len(results))
+
+    return preprocessed_dataset
+
+
 def main(opt):
-    dataset = json.load(open(opt.input_dataset_path))
-    all_db_infos = json.load(open(opt.table_path))
+    dataset = read_dataset(opt.input_dataset_path)
 
     assert opt.mode in ["train", "eval", "test"]
 
     if opt.mode in ["train", "eval"] and opt.target_type == "natsql":
         # only train_spider.json and dev.json have corresponding natsql dataset
-        natsql_dataset = json.load(open(opt.natsql_dataset_path))
+        natsql_dataset = read_dataset(opt.natsql_dataset_path)
     else:
         # empty natsql dataset
-        natsql_dataset = [None for _ in range(len(dataset))]
-
-    db_schemas = get_db_schemas(all_db_infos, opt)
-
-    preprocessed_dataset = []
-
-    for natsql_data, data in tqdm(zip(natsql_dataset, dataset)):
-        if data[
-            'query'] == 'SELECT T1.company_name FROM Third_Party_Companies AS T1 JOIN Maintenance_Contracts AS T2 ON T1.company_id  =  T2.maintenance_contract_company_id JOIN Ref_Company_Types AS T3 ON T1.company_type_code  =  T3.company_type_code ORDER BY T2.contract_end_date DESC LIMIT 1':
-            data[
-                'query'] = 'SELECT T1.company_type FROM Third_Party_Companies AS T1 JOIN Maintenance_Contracts AS T2 ON T1.company_id  =  T2.maintenance_contract_company_id ORDER BY T2.contract_end_date DESC LIMIT 1'
-            data['query_toks'] = ['SELECT', 'T1.company_type', 'FROM', 'Third_Party_Companies', 'AS', 'T1', 'JOIN',
-                                  'Maintenance_Contracts', 'AS', 'T2', 'ON', 'T1.company_id', '=',
-                                  'T2.maintenance_contract_company_id', 'ORDER', 'BY', 'T2.contract_end_date',
-                                  'DESC',
-                                  'LIMIT', '1']
-            data['query_toks_no_value'] = ['select', 't1', '.', 'company_type', 'from', 'third_party_companies',
-                                           'as',
-                                           't1', 'join', 'maintenance_contracts', 'as', 't2', 'on', 't1', '.',
-                                           'company_id', '=', 't2', '.', 'maintenance_contract_company_id', 'order',
-                                           'by', 't2', '.', 'contract_end_date', 'desc', 'limit', 'value']
-            data['question'] = 'What is the type of the company who concluded its contracts most recently?'
-            data['question_toks'] = ['What', 'is', 'the', 'type', 'of', 'the', 'company', 'who', 'concluded', 'its',
-                                     'contracts', 'most', 'recently', '?']
-        if data['query'].startswith(
-                'SELECT T1.fname FROM student AS T1 JOIN lives_in AS T2 ON T1.stuid  =  T2.stuid WHERE T2.dormid IN'):
-            data['query'] = data['query'].replace('IN (SELECT T2.dormid)', 'IN (SELECT T3.dormid)')
-            index = data['query_toks'].index('(') + 2
-            assert data['query_toks'][index] == 'T2.dormid'
-            data['query_toks'][index] = 'T3.dormid'
-            index = data['query_toks_no_value'].index('(') + 2
-            assert data['query_toks_no_value'][index] == 't2'
-            data['query_toks_no_value'][index] = 't3'
-
-        question = data["question"].replace("\u2018", "'").replace("\u2019", "'").replace("\u201c", "'").replace(
-            "\u201d", "'").strip()
-        db_id = data["db_id"]
-
-        if opt.mode == "test":
-            sql, norm_sql, sql_skeleton = "", "", ""
-            sql_tokens = []
-
-            natsql, norm_natsql, natsql_skeleton = "", "", ""
-            natsql_used_columns, natsql_tokens = [], []
-        else:
+        natsql_dataset = repeat(None)
 
-            sql = data["query"].strip()
-            norm_sql = normalization(sql).strip()
-            sql_skeleton = extract_skeleton(norm_sql, db_schemas[db_id]).strip()
-            sql_tokens = norm_sql.split()
-
-            if natsql_data is not None:
-                natsql = natsql_data["NatSQL"].strip()
-                norm_natsql = normalization(natsql).strip()
-                natsql_skeleton = extract_skeleton(norm_natsql, db_schemas[db_id]).strip()
-                natsql_used_columns = [token for token in norm_natsql.split() if "." in token and token != "@.@"]
-                natsql_tokens = []
-                for token in norm_natsql.split():
-                    # split table_name_original.column_name_original
-                    if "." in token:
-                        natsql_tokens.extend(token.split("."))
-                    else:
-                        natsql_tokens.append(token)
-            else:
-                natsql, norm_natsql, natsql_skeleton = "", "", ""
-                natsql_used_columns, natsql_tokens = [], []
-
-        preprocessed_data = {}
-        preprocessed_data["question"] = question
-        preprocessed_data["db_id"] = db_id
-
-        preprocessed_data["sql"] = sql
-        preprocessed_data["norm_sql"] = norm_sql
-        preprocessed_data["sql_skeleton"] = sql_skeleton
-
-        preprocessed_data["natsql"] = natsql
-        preprocessed_data["norm_natsql"] = norm_natsql
-        preprocessed_data["natsql_skeleton"] = natsql_skeleton
-
-        preprocessed_data["db_schema"] = []
-        preprocessed_data["pk"] = db_schemas[db_id]["pk"]
-        preprocessed_data["fk"] = db_schemas[db_id]["fk"]
-        preprocessed_data["table_labels"] = []
-        preprocessed_data["column_labels"] = []
-
-        # add database information (including table name, column name, ..., table_labels, and column labels)
-        for table in db_schemas[db_id]["schema_items"]:
-            db_contents = get_db_contents(
-                question,
-                table["table_name_original"],
-                table["column_names_original"],
-                db_id,
-                opt.db_path
-            )
-
-            preprocessed_data["db_schema"].append({
-                "table_name_original": table["table_name_original"],
-                "table_name": table["table_name"],
-                "column_names": table["column_names"],
-                "column_names_original": table["column_names_original"],
-                "column_types": table["column_types"],
-                "db_contents": db_contents
-            })
-
-            # extract table and column classification labels
-            if opt.target_type == "sql":
-                if table["table_name_original"] in sql_tokens:  # for used tables
-                    preprocessed_data["table_labels"].append(1)
-                    column_labels = []
-                    for column_name_original in table["column_names_original"]:
-                        if column_name_original in sql_tokens or \
-                                table[
-                                    "table_name_original"] + "." + column_name_original in sql_tokens:  # for used columns
-                            column_labels.append(1)
-                        else:
-                            column_labels.append(0)
-                    preprocessed_data["column_labels"].append(column_labels)
-                else:  # for unused tables and their columns
-                    preprocessed_data["table_labels"].append(0)
-                    preprocessed_data["column_labels"].append([0 for _ in range(len(table["column_names_original"]))])
-            elif opt.target_type == "natsql":
-                if table["table_name_original"] in natsql_tokens:  # for used tables
-                    preprocessed_data["table_labels"].append(1)
-                    column_labels = []
-                    for column_name_original in table["column_names_original"]:
-                        if table[
-                            "table_name_original"] + "." + column_name_original in natsql_used_columns:  # for used columns
-                            column_labels.append(1)
-                        else:
-                            column_labels.append(0)
-                    preprocessed_data["column_labels"].append(column_labels)
-                else:
-                    preprocessed_data["table_labels"].append(0)
-                    preprocessed_data["column_labels"].append([0 for _ in range(len(table["column_names_original"]))])
-            else:
-                raise ValueError("target_type should be ``sql'' or ``natsql''")
+    db_schemas = load_schemas(opt.table_path, opt.schema_cache_path)
+    configure_picklist_cache(opt.picklist_cache_dir, opt.picklist_memory_budget * 1024 * 1024)
+    configure_value_sketches(opt.value_sketch_dir, opt.value_sketch_top_k)
+    configure_fts_index(opt.fts_sidecar_dir, opt.fts_max_candidates)
+    configure_column_profiles(opt.column_profile_dir, opt.skip_column_kinds, opt.max_column_mb * 1024 * 1024)
 
-        preprocessed_dataset.append(preprocessed_data)
+    if opt.num_workers > 1:
+        preprocessed_dataset = preprocess_dataset_parallel(natsql_dataset, dataset, db_schemas, opt)
+    else:
+        preprocessed_dataset = (preprocess_data(natsql_data, data, db_schemas, opt)
+                                for natsql_data, data in tqdm(zip(natsql_dataset, dataset)))
 
-    with open(opt.output_dataset_path, "w") as f:
-        preprocessed_dataset_str = json.dumps(preprocessed_dataset, indent=2)
-        f.write(preprocessed_dataset_str)
+    write_dataset(opt.output_dataset_path, preprocessed_dataset, normalize=True)
 
 
 if __name__ == "__main__":
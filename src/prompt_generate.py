@@ -1,5 +1,5 @@
-import json
 import argparse
+from dataset_io import read_dataset, write_dataset
 
 def parse_option():
     parser = argparse.ArgumentParser("command line arguments for generate prompt")
@@ -11,12 +11,7 @@ def parse_option():
     return opt
 
 
-if __name__ == "__main__":
-    opt = parse_option()
-    print(opt)
-    with open(opt.input_dataset_path) as f:
-        data_all = json.load(f)
-    temp = []
+def generate_prompts(data_all):
     for id, data in enumerate(data_all):
         data['input_sequence'] = "### Complete sqlite SQL query only and with no explanation, and do not select extra columns that are not explicitly requested in the query. " \
                         "\n ### Sqlite SQL tables, with their properties: \n#\n"
@@ -36,6 +31,11 @@ if __name__ == "__main__":
         for fk in data['fk']:
             data['input_sequence'] += '\n# ' + fk
         data['input_sequence'] += '\n#\n### ' + data['question'] + '\nSELECT'
-    with open(opt.output_dataset_path, 'w') as f:
-        json.dump(data_all, f, indent=2)
+        yield data
+
 
+if __name__ == "__main__":
+    opt = parse_option()
+    print(opt)
+    data_all = read_dataset(opt.input_dataset_path)
+    write_dataset(opt.output_dataset_path, generate_prompts(data_all))
@@ -0,0 +1,133 @@
+"""
+ Compiled schemas of the databases described by a ``tables.json`` file.
+
+ ``tables.json`` is compiled into the schemas which hold, for every ``db_id``, the per-table column arrays used by preprocessing (``schema_items``,
+ ``pk`` and ``fk``, with lowercased names), lookup maps from table and column names to their
+ positions, the sets of primary keys and the foreign key links, and the original ``tables.json``
+ entry, so the stages only refer to a schema by its ``db_id``. Given a ``cache_path``, the schemas
+ are compiled once into a pickled artefact there, which is rebuilt automatically when ``tables.json``
+ changes (mtime or size); they are compiled on every load otherwise.
+"""
+
+import os
+import json
+import pickle
+import argparse
+from collections import defaultdict
+
+from sqlite_pool import get_db_signature, atomic_write
+
+# bumped whenever the content of a compiled schema changes
+SCHEMA_CACHE_VERSION = 1
+
+
+def compile_db_schema(db) -> dict:
+    table_names_original = db["table_names_original"]
+    table_names = db["table_names"]
+    column_names_original = db["column_names_original"]
+    column_names = db["column_names"]
+    column_types = db["column_types"]
+
+    primary_keys, foreign_keys = [], []
+    # record primary keys
+    for pk_column_idx in db["primary_keys"]:
+        primary_keys.append(
+            {
+                "table_name_original": table_names_original[column_names_original[pk_column_idx][0]].lower(),
+                "column_name_original": column_names_original[pk_column_idx][1].lower()
+            }
+        )
+
+    # record foreign keys
+    for source_column_idx, target_column_idx in db["foreign_keys"]:
+        foreign_keys.append(
+            {
+                "source_table_name_original": table_names_original[column_names_original[source_column_idx][0]].lower(),
+                "source_column_name_original": column_names_original[source_column_idx][1].lower(),
+                "target_table_name_original": table_names_original[column_names_original[target_column_idx][0]].lower(),
+                "target_column_name_original": column_names_original[target_column_idx][1].lower(),
+            }
+        )
+
+    # group the columns by table in a single pass (the column "*" belongs to no table)
+    columns_by_table = defaultdict(list)
+    for column_idx, (table_idx, column_name_original) in enumerate(column_names_original):
+        columns_by_table[table_idx].append(column_idx)
+
+    schema_items = []
+    for idx, table_name_original in enumerate(table_names_original):
+        schema_items.append({
+            "table_name_original": table_name_original.lower(),
+            "table_name": table_names[idx].lower(),
+            "column_names": [column_names[column_idx][1].lower() for column_idx in columns_by_table[idx]],
+            "column_names_original": [column_names_original[column_idx][1].lower()
+                                      for column_idx in columns_by_table[idx]],
+            "column_types": [column_types[column_idx] for column_idx in columns_by_table[idx]]
+        })
+
+    foreign_key_links = defaultdict(list)
+    for fk in foreign_keys:
+        foreign_key_links[fk["source_table_name_original"] + "." + fk["source_column_name_original"]].append(
+            fk["target_table_name_original"] + "." + fk["target_column_name_original"])
+
+    return {
+        "db_id": db["db_id"],
+        "pk": primary_keys,
+        "fk": foreign_keys,
+        "schema_items": schema_items,
+        "table_names_original": [table["table_name_original"] for table in schema_items],
+        "table_index": {table["table_name_original"]: idx for idx, table in enumerate(schema_items)},
+        "column_index": {table["table_name_original"]: {column: idx for idx, column in
+                                                        enumerate(table["column_names_original"])}
+                         for table in schema_items},
+        "pk_set": {pk["table_name_original"] + "." + pk["column_name_original"] for pk in primary_keys},
+        "fk_map": dict(foreign_key_links),
+        "entry": db
+    }
+
+
+def compile_schemas(all_db_infos) -> dict:
+    return {db["db_id"]: compile_db_schema(db) for db in all_db_infos}
+
+
+def build_schemas(table_path: str, cache_path: str = None) -> dict:
+    signature = get_db_signature(table_path)
+    with open(table_path) as f:
+        db_schemas = compile_schemas(json.load(f))
+    if cache_path is None:
+        return db_schemas
+    data = pickle.dumps({"version": SCHEMA_CACHE_VERSION, "signature": signature, "db_schemas": db_schemas},
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        atomic_write(cache_path, data)
+    except OSError as e:
+        print(f"cannot write the schema cache {cache_path}: {e}")
+    return db_schemas
+
+
+def load_schemas(table_path: str, cache_path: str = None) -> dict:
+    """Compiled schemas of ``table_path`` by ``db_id``, from the ``cache_path`` artefact if it is up to date."""
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            artefact = pickle.load(f)
+        if artefact["version"] == SCHEMA_CACHE_VERSION and artefact["signature"] == get_db_signature(table_path):
+            return artefact["db_schemas"]
+    return build_schemas(table_path, cache_path)
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for compiling the schemas")
+    parser.add_argument("--table_path", type=str, default="./data/spider/tables.json")
+    parser.add_argument("--cache_path", type=str, required=True,
+                        help="path of the compiled schemas.")
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    db_schemas = build_schemas(opt.table_path, opt.cache_path)
+    print(f"compiled {len(db_schemas)} schemas into {opt.cache_path}")
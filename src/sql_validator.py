@@ -0,0 +1,77 @@
+"""
+ Prepare-only validation of SQL queries.
+
+ A query is valid if SQLite can compile it against the schema of the database: it is run under
+ ``EXPLAIN``, which prepares the statement without reading any table, on a read-only connection
+ from the shared pool. Verdicts are cached by the hash of the query and the signature of the
+ database file, so repeated candidates are checked only once until the database changes.
+"""
+
+import re
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import sqlite_pool
+
+
+def replace_cur_year(query: str) -> str:
+    return re.sub(
+        "YEAR\s*\(\s*CURDATE\s*\(\s*\)\s*\)\s*", "2020", query, flags=re.IGNORECASE
+    )
+
+
+def get_sql_key(sql: str) -> str:
+    return hashlib.sha1(sql.encode("utf-8")).hexdigest()
+
+
+class SQLValidator(object):
+    def __init__(self, max_verdicts: int = 100000) -> None:
+        self.max_verdicts = max_verdicts
+        # (db path, db signature, sql hash) -> verdict, least recently used first
+        self.verdicts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_valid(self, sql: str, db_path: str) -> bool:
+        # a missing or unreadable database is not a verdict on the query, nothing is cached
+        try:
+            key = (db_path, tuple(sqlite_pool.get_db_signature(db_path)), get_sql_key(sql))
+        except OSError:
+            return False
+        with self.lock:
+            if key in self.verdicts:
+                self.verdicts.move_to_end(key)
+                return self.verdicts[key]
+
+        try:
+            connection = sqlite_pool.connection_pool.acquire(db_path)
+        except (OSError, sqlite3.Error):
+            return False
+        cursor = connection.cursor()
+        try:
+            cursor.execute("EXPLAIN " + replace_cur_year(sql))
+            verdict = True
+        except Exception:
+            verdict = False
+        finally:
+            cursor.close()
+            sqlite_pool.connection_pool.release(db_path, connection)
+
+        with self.lock:
+            self.verdicts[key] = verdict
+            self.verdicts.move_to_end(key)
+            if len(self.verdicts) > self.max_verdicts:
+                self.verdicts.popitem(last=False)
+        return verdict
+
+    def clear(self) -> None:
+        with self.lock:
+            self.verdicts.clear()
+
+
+sql_validator = SQLValidator()
+
+
+def is_valid_sql(sql: str, db_path: str) -> bool:
+    return sql_validator.is_valid(sql, db_path)
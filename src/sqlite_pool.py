@@ -0,0 +1,176 @@
+"""
+ Pool of read-only SQLite connections shared by the whole pipeline.
+
+ Connections are opened once per database file with the ``mode=ro&immutable=1`` URI, so SQLite
+ neither takes locks nor re-reads the schema for every query, and are handed back to the pool
+ after use. At most ``max_idle`` idle connections are kept per database, and the connections of
+ the least recently used databases are closed once more than ``max_databases`` are open. A
+ database file whose mtime or size changed is reopened, as immutable connections would not see
+ the change. A database in WAL mode which has a write-ahead log is opened without ``immutable=1``
+ (which would ignore the log), and the mtime and size of its log are part of its signature, so
+ the writes which only reach the log are seen too.
+
+ This module only depends on the standard library: the evaluation scripts in
+ third_party/test-suite-sql-eval import it too (with src/ on the PYTHONPATH).
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def get_wal_path(db_path: str) -> str:
+    return db_path + "-wal"
+
+
+def get_db_signature(db_path: str) -> list:
+    stat = os.stat(db_path)
+    signature = [stat.st_mtime_ns, stat.st_size]
+    try:
+        wal_stat = os.stat(get_wal_path(db_path))
+    except FileNotFoundError:
+        return signature
+    return signature + [wal_stat.st_mtime_ns, wal_stat.st_size]
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def open_connection(db_path: str):
+    if os.path.exists(get_wal_path(db_path)):
+        uri = Path(db_path).as_uri() + "?mode=ro"
+    else:
+        uri = Path(db_path).as_uri() + "?mode=ro&immutable=1"
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+class ConnectionPool(object):
+    def __init__(self, max_databases: int = 64, max_idle: int = 4) -> None:
+        self.max_databases = max_databases
+        self.max_idle = max_idle
+        # db path -> (signature, idle connections), least recently used first
+        self.databases = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, db_path: str, text_factory=str):
+        db_path = os.path.abspath(db_path)
+        # raises for a missing file instead of creating an empty database
+        signature = get_db_signature(db_path)
+        connection = None
+        with self.lock:
+            if db_path in self.databases:
+                entry_signature, idle = self.databases[db_path]
+                if entry_signature != signature:
+                    self._close(db_path)
+                else:
+                    self.databases.move_to_end(db_path)
+                    if idle:
+                        connection = idle.pop()
+            if db_path not in self.databases:
+                self.databases[db_path] = (signature, [])
+                while len(self.databases) > self.max_databases:
+                    self._close(next(iter(self.databases)))
+        if connection is None:
+            connection = open_connection(db_path)
+        connection.text_factory = text_factory
+        return connection
+
+    def release(self, db_path: str, connection) -> None:
+        db_path = os.path.abspath(db_path)
+        with self.lock:
+            if db_path in self.databases:
+                _, idle = self.databases[db_path]
+                if len(idle) < self.max_idle:
+                    idle.append(connection)
+                    return
+        # the database was evicted (or has enough idle connections) meanwhile
+        connection.close()
+
+    @contextmanager
+    def connection(self, db_path: str, text_factory=str):
+        connection = self.acquire(db_path, text_factory)
+        try:
+            yield connection
+        finally:
+            self.release(db_path, connection)
+
+    def invalidate(self, db_path: str) -> None:
+        """Close the idle connections of ``db_path``, which was written without changing its signature."""
+        db_path = os.path.abspath(db_path)
+        with self.lock:
+            if db_path in self.databases:
+                self._close(db_path)
+
+    def close(self) -> None:
+        with self.lock:
+            for db_path in list(self.databases):
+                self._close(db_path)
+
+    def _close(self, db_path: str) -> None:
+        _, idle = self.databases.pop(db_path)
+        for connection in idle:
+            connection.close()
+
+
+connection_pool = ConnectionPool()
+
+
+# connections must not be shared with forked workers, which start with an empty pool
+def reset_after_fork() -> None:
+    global connection_pool
+    connection_pool = ConnectionPool(max_databases=connection_pool.max_databases, max_idle=connection_pool.max_idle)
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def configure_connection_pool(max_databases: int = 64, max_idle: int = 4) -> ConnectionPool:
+    global connection_pool
+    connection_pool.close()
+    connection_pool = ConnectionPool(max_databases=max_databases, max_idle=max_idle)
+    return connection_pool
+
+
+def decode_text(b: bytes) -> str:
+    return b.decode(errors="ignore")
+
+
+# number of sqlite virtual machine instructions between two checks of the deadline
+PROGRESS_STEPS = 10000
+
+
+class QueryLimitExceeded(Exception):
+    pass
+
+
+# execute query on connection, interrupting it once it runs longer than timeout seconds
+# (the progress handler is called by sqlite itself, so this also stops long joins and sorts)
+# or returns more than max_rows rows; no limit for a None timeout or max_rows
+def execute_with_limits(connection, query: str, timeout: float = None, max_rows: int = None) -> list:
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    cursor = connection.cursor()
+    try:
+        if deadline is not None:
+            connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+        cursor.execute(query)
+        if max_rows is None:
+            return cursor.fetchall()
+        result = cursor.fetchmany(max_rows + 1)
+        if len(result) > max_rows:
+            raise QueryLimitExceeded("query returns more than %d rows" % max_rows)
+        return result
+    except sqlite3.OperationalError as e:
+        if deadline is not None and time.monotonic() > deadline:
+            raise TimeoutError("query runs longer than %s seconds" % timeout) from e
+        raise
+    finally:
+        cursor.close()
+        connection.set_progress_handler(None, 0)
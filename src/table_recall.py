@@ -1,9 +1,11 @@
-import json
 import argparse
 import openai
-import time
 from tqdm import tqdm
 from collections import Counter
+from dataset_io import read_dataset, write_dataset
+from llm_client import AsyncChatClient, ordered_map
+from completion_cache import configure_completion_cache
+from schema_cache import load_schemas
 
 # add your openai api key
 openai.api_key = "sk-"
@@ -16,14 +18,33 @@ def parse_option():
     parser.add_argument("--n", type=int, default=10,
                         help="Size of self-consistent set")
     parser.add_argument("--output_recalled_tables_path", type=str)
+    parser.add_argument("--table_path", type=str, default="./data/spider/tables.json",
+                        help="tables.json of the databases.")
+    parser.add_argument("--schema_cache_path", type=str, default=None,
+                        help="file caching the compiled schemas of table_path, compiled on every run if not given.")
+    parser.add_argument("--max_concurrency", type=int, default=8,
+                        help="maximum number of requests in flight")
+    parser.add_argument("--requests_per_minute", type=float, default=3500)
+    parser.add_argument("--tokens_per_minute", type=float, default=90000)
+    parser.add_argument("--max_retries", type=int, default=8,
+                        help="retries of a failed request, with exponential backoff")
+    parser.add_argument("--api_base", type=str, default=None,
+                        help="base url of the API, e.g. a local server for testing")
+    parser.add_argument("--completion_cache_path", type=str, default=None,
+                        help="sqlite file caching the completions, no caching if not given.")
+    parser.add_argument("--completion_cache_ttl", type=float, default=None,
+                        help="seconds after which a cached completion expires.")
+    parser.add_argument("--completion_cache_max_mb", type=int, default=None,
+                        help="size (in MB) above which the least recently used completions are evicted.")
 
     opt = parser.parse_args()
 
     return opt
 
 
-def generate_reply(input, sc_num):
-    completions = openai.ChatCompletion.create(
+async def generate_reply(client, input, sc_num, attempt=0):
+    completions = await client.create(
+        attempt=attempt,
         model="gpt-3.5-turbo",
         messages=input,
         # top_p=0.5
@@ -45,7 +66,6 @@ def generate_reply(input, sc_num):
             return None
         all_tables.append(raw_table)
     return all_tables
-    # return completions.choices[0].message.content
 
 
 def generate_schema(data):
@@ -82,7 +102,7 @@ def table_sc(tables_all, tables_ori):
             return table_list
 
 
-def info_generate(tables, data):
+def info_generate(tables, data, db_schema):
     info = {}
     info['db_id'] = data['db_id']
     info['question'] = data['question']
@@ -93,7 +113,7 @@ def info_generate(tables, data):
             if table == tab_ori['table_name_original'].lower():
                 info['db_schema'].append(tab_ori)
                 break
-    for fk in data['fk']:
+    for fk in db_schema['fk']:
         if fk['source_table_name_original'] in tables and fk['target_table_name_original'] in tables:
             fk_str = fk['source_table_name_original'] + '.' + fk['source_column_name_original'] + ' = ' \
                      + fk['target_table_name_original'] + '.' + fk['target_column_name_original']
@@ -111,33 +131,43 @@ instruction = """Given the database schema and question, perform the following a
 
 """
 
+async def recall_table(client, data, sc_num, db_schemas):
+    schema = generate_schema(data)
+    prompt = instruction + "Schema:\n" + schema + "\n"
+    prompt += "Question:\n" + data["question"]
+    tables_all = None
+    attempt = 0
+    # api errors are retried by the client, here we only ask again for unparsable replies
+    while tables_all is None:
+        tables_all = await generate_reply(client, [{"role": "user", "content": prompt}], sc_num, attempt)
+        attempt += 1
+    tables_ori = []
+    for table in data['db_schema']:
+        tables_ori.append(table['table_name_original'].lower())
+    tables = table_sc(tables_all, tables_ori)
+    info = info_generate(tables, data, db_schemas[data['db_id']])
+    return info
+
+
+def recall_tables(data_all, sc_num, client, db_schemas):
+    # keep a few requests queued per connection, results come back in input order
+    window = 4 * client.max_concurrency
+    return tqdm(ordered_map(lambda data: recall_table(client, data, sc_num, db_schemas), data_all, window))
+
+
 if __name__ == "__main__":
     opt = parse_option()
     print(opt)
-    with open(opt.input_dataset_path) as f:
-        data_all = json.load(f)
-    res = []
+    if opt.api_base is not None:
+        openai.api_base = opt.api_base
+    configure_completion_cache(opt.completion_cache_path, opt.completion_cache_ttl,
+                               opt.completion_cache_max_mb * 1024 * 1024 if opt.completion_cache_max_mb else None)
     if opt.self_consistent:
         sc_num = opt.n
     else:
         sc_num = 1
-    for i, data in enumerate(tqdm(data_all)):
-        schema = generate_schema(data)
-        prompt = instruction + "Schema:\n" + schema + "\n"
-        prompt += "Question:\n" + data["question"]
-        tables_all = None
-        while tables_all is None:
-            try:
-                tables_all = generate_reply([{"role": "user", "content": prompt}], sc_num)
-            except:
-                print(f'api error, wait for 3 seconds and retry...')
-                time.sleep(3)
-                pass
-        tables_ori = []
-        for table in data['db_schema']:
-            tables_ori.append(table['table_name_original'].lower())
-        tables = table_sc(tables_all, tables_ori)
-        info = info_generate(tables, data)
-        res.append(info)
-    with open(opt.output_recalled_tables_path, 'w') as f:
-        json.dump(res, f, indent=2)
+    client = AsyncChatClient(max_concurrency=opt.max_concurrency, requests_per_minute=opt.requests_per_minute,
+                             tokens_per_minute=opt.tokens_per_minute, max_retries=opt.max_retries)
+    db_schemas = load_schemas(opt.table_path, opt.schema_cache_path)
+    data_all = read_dataset(opt.input_dataset_path)
+    write_dataset(opt.output_recalled_tables_path, recall_tables(data_all, sc_num, client, db_schemas), normalize=True)
@@ -4,6 +4,8 @@ import argparse
 import random
 import numpy as np
 
+from schema_cache import load_schemas
+
 
 def parse_option():
     parser = argparse.ArgumentParser("command line arguments for generating the ranked dataset.")
@@ -12,6 +14,10 @@ def parse_option():
                         help='filepath of the input dataset.')
     parser.add_argument('--output_dataset_path', type=str, default="./data/pre-processing/resdsql_dev.json",
                         help='filepath of the output dataset.')
+    parser.add_argument("--table_path", type=str, default="./data/spider/tables.json",
+                        help="tables.json file whose compiled schemas hold the foreign keys of each db_id.")
+    parser.add_argument("--schema_cache_path", type=str, default=None,
+                        help="file caching the compiled schemas of table_path, compiled on every run if not given.")
     parser.add_argument('--topk_table_num', type=int, default=4,
                         help='we only remain topk_table_num tables in the ranked dataset (k_1 in the paper).')
     parser.add_argument('--topk_column_num', type=int, default=5,
@@ -259,6 +265,8 @@ def prepare_input_and_output_predict_schema_items(opt, ranked_data):
 def generate_train_ranked_dataset(opt):
     with open(opt.input_dataset_path) as f:
         dataset = json.load(f)
+    # the foreign keys are looked up by db_id, the preprocessed records do not carry them
+    db_schemas = load_schemas(opt.table_path, opt.schema_cache_path)
 
     output_dataset = []
     for data_id, data in enumerate(dataset):
@@ -326,7 +334,7 @@ def generate_train_ranked_dataset(opt):
         # record foreign keys
         table_names_original = [table["table_name_original"] for table in data["db_schema"]]
         needed_fks = []
-        for fk in data["fk"]:
+        for fk in db_schemas[data["db_id"]]["fk"]:
             source_table_id = table_names_original.index(fk["source_table_name_original"])
             target_table_id = table_names_original.index(fk["target_table_name_original"])
             if source_table_id in topk_table_ids and target_table_id in topk_table_ids:
@@ -361,6 +369,8 @@ def generate_train_ranked_dataset(opt):
 def generate_eval_ranked_dataset(opt):
     with open(opt.input_dataset_path) as f:
         dataset = json.load(f)
+    # the foreign keys are looked up by db_id, the preprocessed records do not carry them
+    db_schemas = load_schemas(opt.table_path, opt.schema_cache_path)
 
     table_coverage_state_list, column_coverage_state_list = [], []
     output_dataset = []
@@ -410,7 +420,7 @@ def generate_eval_ranked_dataset(opt):
         # record foreign keys among selected tables
         table_names_original = [table["table_name_original"] for table in data["db_schema"]]
         needed_fks = []
-        for fk in data["fk"]:
+        for fk in db_schemas[data["db_id"]]["fk"]:
             source_table_id = table_names_original.index(fk["source_table_name_original"])
             target_table_id = table_names_original.index(fk["target_table_name_original"])
             if source_table_id in topk_table_ids and target_table_id in topk_table_ids:
@@ -0,0 +1,361 @@
+"""
+ MinHash-LSH sketches of the values of high-cardinality text columns.
+
+ A sketch is built offline from the picklist of a column (``get_column_picklist``) and saved under
+ ``sketch_dir``, next to the database signature it was built from. Every value is reduced to the set
+ of its character trigrams, hashed with ``num_perm`` MinHash permutations and filed under one
+ bucket per band of ``num_perm / num_bands`` hashes. At query time the word spans of the question
+ are hashed the same way, and only the values sharing a bucket with a span are scored (by exact
+ trigram Jaccard) and handed to the exact matcher, instead of the whole picklist.
+
+ The recall/precision trade-off is set by ``num_bands`` (more bands of fewer hashes find less
+ similar values but return larger buckets) at build time, and by ``top_k``, ``min_similarity`` and
+ ``max_span_words`` at query time; ``--mode evaluate`` measures it against the exact matcher.
+ Columns without an up-to-date sketch are matched exactly.
+"""
+
+import os
+import re
+import time
+import zlib
+import array
+import bisect
+import pickle
+import random
+import struct
+import hashlib
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+from typing import List
+
+import column_profile
+from column_profile import get_db_columns
+from dataset_io import read_dataset
+from picklist_cache import get_db_key, get_column_key, is_changed_column, is_current_entry
+from sqlite_pool import get_db_signature, atomic_write
+
+# bumped whenever the content of a sketch changes
+VALUE_SKETCH_VERSION = 3
+# Mersenne prime of the universal hash family
+_prime = (1 << 61) - 1
+_span_separators = re.compile("[{}]+".format(re.escape("'\"()`,.?! ")))
+
+
+def get_words(s: str) -> List[str]:
+    return [word for word in _span_separators.split(s.lower()) if word]
+
+
+def get_trigrams(s: str) -> set:
+    s = " {} ".format(s)
+    return {s[i: i + 3] for i in range(len(s) - 2)}
+
+
+def jaccard(a: set, b: set) -> float:
+    common = len(a & b)
+    return common / (len(a) + len(b) - common) if a or b else 0.0
+
+
+class MinHashLSH(object):
+    def __init__(self, num_perm: int = 64, num_bands: int = 16, seed: int = 1) -> None:
+        assert num_perm % num_bands == 0, "num_perm must be a multiple of num_bands"
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows = num_perm // num_bands
+        self.seed = seed
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, _prime), rng.randrange(0, _prime)) for _ in range(num_perm)]
+        self.field_values = []
+        # per band: sorted bucket keys and the value ids aligned with them
+        self.band_keys = [array.array("q") for _ in range(num_bands)]
+        self.band_ids = [array.array("I") for _ in range(num_bands)]
+
+    def get_band_keys(self, grams: set) -> List[int]:
+        hashes = [zlib.crc32(gram.encode("utf-8")) for gram in grams]
+        signature = [min([(a * h + b) % _prime for h in hashes]) for a, b in self.permutations]
+        band_keys = []
+        for i in range(self.num_bands):
+            # a digest of the packed band, hash() of a tuple is not stable across python versions
+            band = struct.pack("<{}Q".format(self.rows), *signature[i * self.rows: (i + 1) * self.rows])
+            band_keys.append(int.from_bytes(hashlib.blake2b(band, digest_size=8).digest(), "little", signed=True))
+        return band_keys
+
+    def build(self, field_values: List[str]) -> "MinHashLSH":
+        self.field_values = field_values
+        entries = [[] for _ in range(self.num_bands)]
+        for idx, field_value in enumerate(field_values):
+            words = get_words(field_value)
+            if not words:
+                continue
+            for band, key in enumerate(self.get_band_keys(get_trigrams(" ".join(words)))):
+                entries[band].append((key, idx))
+        for band in range(self.num_bands):
+            entries[band].sort()
+            self.band_keys[band] = array.array("q", [key for key, _ in entries[band]])
+            self.band_ids[band] = array.array("I", [idx for _, idx in entries[band]])
+        return self
+
+    # sketches are saved as plain data, so that they load whichever module built them
+    def to_dict(self) -> dict:
+        return {"num_perm": self.num_perm, "num_bands": self.num_bands, "seed": self.seed,
+                "field_values": self.field_values, "band_keys": self.band_keys, "band_ids": self.band_ids}
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "MinHashLSH":
+        sketch = cls(num_perm=state["num_perm"], num_bands=state["num_bands"], seed=state["seed"])
+        sketch.field_values = state["field_values"]
+        sketch.band_keys, sketch.band_ids = state["band_keys"], state["band_ids"]
+        return sketch
+
+    def query(self, grams: set) -> set:
+        candidates = set()
+        for band, key in enumerate(self.get_band_keys(grams)):
+            keys, ids = self.band_keys[band], self.band_ids[band]
+            i = bisect.bisect_left(keys, key)
+            while i < len(keys) and keys[i] == key:
+                candidates.add(ids[i])
+                i += 1
+        return candidates
+
+    def shortlist(self, question: str, top_k: int = 20, min_similarity: float = 0.3,
+                  max_span_words: int = 4) -> List[str]:
+        """The ``top_k'' nearest values of every word span of ``question'', in picklist order."""
+        words = get_words(question)
+        spans = {" ".join(words[i: j]) for i in range(len(words))
+                 for j in range(i + 1, min(i + max_span_words, len(words)) + 1)}
+        shortlisted = set()
+        # spans sharing words retrieve the same values, their trigrams are computed once
+        value_grams = {}
+        for span in spans:
+            span_grams = get_trigrams(span)
+            scored = []
+            for idx in self.query(span_grams):
+                if idx not in value_grams:
+                    value_grams[idx] = get_trigrams(" ".join(get_words(self.field_values[idx])))
+                similarity = jaccard(span_grams, value_grams[idx])
+                if similarity >= min_similarity:
+                    scored.append((-similarity, idx))
+            shortlisted.update(idx for _, idx in sorted(scored)[:top_k])
+        return [self.field_values[idx] for idx in sorted(shortlisted)]
+
+
+class ValueSketchStore(object):
+    def __init__(self, sketch_dir: str = None, top_k: int = 20, min_similarity: float = 0.3,
+                 max_span_words: int = 4, max_loaded: int = 8) -> None:
+        self.sketch_dir = sketch_dir
+        self.top_k = top_k
+        self.min_similarity = min_similarity
+        self.max_span_words = max_span_words
+        self.max_loaded = max_loaded
+        # (db path, table, column) -> (signature, sketch or None), least recently used first
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+
+    def sketch_path(self, db_path: str, table_name: str, column_name: str) -> str:
+        return os.path.join(self.sketch_dir, get_db_key(db_path),
+                            get_column_key(table_name.lower(), column_name.lower()) + ".pkl")
+
+    def get(self, db_path: str, table_name: str, column_name: str):
+        """The sketch of a column if one was built from the current database file, None otherwise."""
+        if self.sketch_dir is None:
+            return None
+        signature = get_db_signature(db_path)
+        key = (os.path.abspath(db_path), table_name, column_name)
+        with self.lock:
+            if key in self.loaded and self.loaded[key][0] == signature:
+                self.loaded.move_to_end(key)
+                return self.loaded[key][1]
+
+        sketch = None
+        path = self.sketch_path(db_path, table_name, column_name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                artefact = pickle.load(f)
+            if artefact["version"] == VALUE_SKETCH_VERSION and artefact["signature"] == signature:
+                sketch = MinHashLSH.from_dict(artefact["sketch"])
+
+        with self.lock:
+            self.loaded[key] = (signature, sketch)
+            self.loaded.move_to_end(key)
+            # only the sketches count against the limit, missing ones are cheap to remember
+            while sum(entry[1] is not None for entry in self.loaded.values()) > self.max_loaded:
+                evicted = next(k for k, entry in self.loaded.items() if entry[1] is not None)
+                del self.loaded[evicted]
+        return sketch
+
+    def shortlist(self, sketch: MinHashLSH, question: str) -> List[str]:
+        return sketch.shortlist(question, self.top_k, self.min_similarity, self.max_span_words)
+
+    def save(self, db_path: str, table_name: str, column_name: str, sketch: MinHashLSH, signature: list) -> None:
+        path = self.sketch_path(db_path, table_name, column_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = pickle.dumps({"version": VALUE_SKETCH_VERSION, "signature": signature, "table_name": table_name,
+                             "column_name": column_name, "sketch": sketch.to_dict()},
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        atomic_write(path, data)
+
+    def refresh(self, db_path: str, changed_columns=None, since_signature: list = None) -> None:
+        """
+        Make the sketches of ``db_path`` valid for its current file: the ones of ``changed_columns``
+        (all if None) are built again with the same parameters, the others are kept if they were
+        built from the file of ``since_signature``.
+        """
+        if self.sketch_dir is None or not os.path.isdir(os.path.join(self.sketch_dir, get_db_key(db_path))):
+            return
+        signature = get_db_signature(db_path)
+        db_sketch_dir = os.path.join(self.sketch_dir, get_db_key(db_path))
+        for file_name in os.listdir(db_sketch_dir):
+            if not file_name.endswith(".pkl"):
+                continue
+            path = os.path.join(db_sketch_dir, file_name)
+            with open(path, "rb") as f:
+                artefact = pickle.load(f)
+            if artefact["version"] != VALUE_SKETCH_VERSION:
+                os.remove(path)
+                continue
+            table_name, column_name = artefact["table_name"], artefact["column_name"]
+            changed = is_changed_column(table_name, column_name, changed_columns)
+            if is_current_entry(artefact["signature"], signature, since_signature, changed):
+                continue
+            sketch = MinHashLSH.from_dict(artefact["sketch"])
+            if artefact["signature"] != since_signature or changed:
+                sketch = build_column_sketch(db_path, table_name, column_name, sketch.num_perm, sketch.num_bands)
+                if sketch is None:
+                    os.remove(path)
+                    continue
+            self.save(db_path, table_name, column_name, sketch, signature)
+        with self.lock:
+            abs_db_path = os.path.abspath(db_path)
+            for key in [key for key in self.loaded if key[0] == abs_db_path]:
+                del self.loaded[key]
+
+
+value_sketch_store = ValueSketchStore()
+
+
+def configure_value_sketches(sketch_dir: str = None, top_k: int = 20, min_similarity: float = 0.3,
+                             max_span_words: int = 4) -> ValueSketchStore:
+    global value_sketch_store
+    value_sketch_store = ValueSketchStore(sketch_dir=sketch_dir, top_k=top_k, min_similarity=min_similarity,
+                                          max_span_words=max_span_words)
+    return value_sketch_store
+
+
+def build_column_sketch(db_path: str, table_name: str, column_name: str, num_perm: int = 64,
+                        num_bands: int = 16, min_values: int = 1) -> MinHashLSH:
+    """Sketch of a column if it has at least ``min_values`` distinct text values, None otherwise."""
+    # the bridge encoder imports this module, so the picklists are only imported when building
+    from bridge_content_encoder import get_column_picklist
+
+    try:
+        # the profile tells the small columns apart without fetching their values
+        profile = column_profile.column_profiler.get(db_path, table_name, column_name)
+        if profile["num_distinct_text"] < min_values:
+            return None
+        picklist = get_column_picklist(table_name, column_name, db_path)
+    except sqlite3.Error as e:
+        print(f"cannot read {db_path} {table_name}.{column_name}: {e}")
+        return None
+    # the same values, in the same order, as the exact value index
+    picklist = sorted(ele.strip() for ele in picklist if isinstance(ele, str))
+    if len(picklist) < min_values:
+        return None
+    return MinHashLSH(num_perm=num_perm, num_bands=num_bands).build(picklist)
+
+
+def build_db_sketches(db_path: str, store: ValueSketchStore, min_values: int = 100000,
+                      num_perm: int = 64, num_bands: int = 16) -> List[tuple]:
+    """Sketch every column of ``db_path`` with at least ``min_values`` distinct text values."""
+    signature = get_db_signature(db_path)
+    built = []
+    for table_name, column_name in get_db_columns(db_path):
+        sketch = build_column_sketch(db_path, table_name, column_name, num_perm, num_bands, min_values)
+        if sketch is None:
+            continue
+        store.save(db_path, table_name, column_name, sketch, signature)
+        built.append((table_name, column_name, len(sketch.field_values)))
+    return built
+
+
+def evaluate_sketches(dataset, db_dir: str, top_k_matches: int = 2) -> dict:
+    """
+    Recall and precision of the sketched matches against the exact matches, on the sketched columns
+    which the column profiles do not skip (both sides would have no match)
+    """
+    from bridge_content_encoder import get_database_matches
+
+    num_exact, num_approximate, num_common, num_queries = 0, 0, 0, 0
+    exact_time, approximate_time = 0.0, 0.0
+    for data in dataset:
+        db_path = os.path.join(db_dir, data["db_id"], data["db_id"] + ".sqlite")
+        for table_name, column_name in get_db_columns(db_path):
+            if value_sketch_store.get(db_path, table_name, column_name) is None or \
+                    column_profile.column_profiler.should_skip(db_path, table_name, column_name):
+                continue
+            start = time.perf_counter()
+            exact = get_database_matches(data["question"], table_name, column_name, db_path, top_k_matches,
+                                         approximate=False)
+            exact_time += time.perf_counter() - start
+            start = time.perf_counter()
+            approximate = get_database_matches(data["question"], table_name, column_name, db_path, top_k_matches)
+            approximate_time += time.perf_counter() - start
+            num_exact += len(exact)
+            num_approximate += len(approximate)
+            num_common += len(set(exact) & set(approximate))
+            num_queries += 1
+    return {
+        "queries": num_queries,
+        "recall": num_common / num_exact if num_exact else 1.0,
+        "precision": num_common / num_approximate if num_approximate else 1.0,
+        "exact_ms_per_query": 1000 * exact_time / max(num_queries, 1),
+        "sketch_ms_per_query": 1000 * approximate_time / max(num_queries, 1),
+    }
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for the value sketches")
+    parser.add_argument("--mode", type=str, default="build", help="build or evaluate.")
+    parser.add_argument("--db_dir", type=str, default="./data/spider/database")
+    parser.add_argument("--db_ids", type=str, nargs="*", default=None,
+                        help="databases to sketch, every database of db_dir if not given.")
+    parser.add_argument("--sketch_dir", type=str, required=True)
+    parser.add_argument("--min_values", type=int, default=100000,
+                        help="columns with fewer distinct text values are matched exactly.")
+    parser.add_argument("--num_perm", type=int, default=64)
+    parser.add_argument("--num_bands", type=int, default=16)
+    parser.add_argument("--top_k", type=int, default=20,
+                        help="number of values shortlisted per question span.")
+    parser.add_argument("--min_similarity", type=float, default=0.3,
+                        help="trigram jaccard below which a value is not shortlisted.")
+    parser.add_argument("--max_span_words", type=int, default=4)
+    parser.add_argument("--input_dataset_path", type=str, default="./data/spider/dev.json",
+                        help="questions the sketches are evaluated on.")
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+def main(opt):
+    store = configure_value_sketches(opt.sketch_dir, opt.top_k, opt.min_similarity, opt.max_span_words)
+    if opt.mode == "build":
+        for db_id in opt.db_ids or sorted(os.listdir(opt.db_dir)):
+            db_path = os.path.join(opt.db_dir, db_id, db_id + ".sqlite")
+            if not os.path.exists(db_path):
+                continue
+            for table_name, column_name, num_values in build_db_sketches(db_path, store, opt.min_values,
+                                                                         opt.num_perm, opt.num_bands):
+                print(f"{db_id}: sketched {table_name}.{column_name} ({num_values} values)")
+    elif opt.mode == "evaluate":
+        dataset = [data for data in read_dataset(opt.input_dataset_path)
+                   if opt.db_ids is None or data["db_id"] in opt.db_ids]
+        print(evaluate_sketches(dataset, opt.db_dir))
+    else:
+        raise ValueError("mode should be ``build'' or ``evaluate''")
+
+
+if __name__ == "__main__":
+    # run in the importable module, whose sketch store is the one the bridge encoder reads
+    import value_sketch
+    value_sketch.main(parse_option())
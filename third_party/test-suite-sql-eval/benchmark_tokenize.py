@@ -0,0 +1,104 @@
+"""
+ Micro-benchmark of process_sql.tokenize against the nltk-based tokenizer it replaced.
+
+ Every query of the gold and predicted files is tokenized by both, the token streams are compared
+ and the time per query is printed. nltk is only needed by this script; without the punkt sentence
+ model the queries are word tokenized as single sentences.
+"""
+
+import time
+import argparse
+
+from process_sql import tokenize
+
+
+def nltk_tokenize(string, word_tokenize):
+    string = str(string)
+    string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
+    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
+    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
+
+    # keep string value as token
+    vals = {}
+    for i in range(len(quote_idxs)-1, -1, -2):
+        qidx1 = quote_idxs[i-1]
+        qidx2 = quote_idxs[i]
+        val = string[qidx1: qidx2+1]
+        key = "__val_{}_{}__".format(qidx1, qidx2)
+        string = string[:qidx1] + key + string[qidx2+1:]
+        vals[key] = val
+
+    toks = [word.lower() for word in word_tokenize(string)]
+    # replace with string value token
+    for i in range(len(toks)):
+        if toks[i] in vals:
+            toks[i] = vals[toks[i]]
+
+    # find if there exists !=, >=, <=
+    eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
+    eq_idxs.reverse()
+    prefix = ('!', '>', '<')
+    for eq_idx in eq_idxs:
+        pre_tok = toks[eq_idx-1]
+        if pre_tok in prefix:
+            toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1: ]
+
+    return toks
+
+
+def get_word_tokenize():
+    from nltk import word_tokenize
+    try:
+        word_tokenize("SELECT 1")
+        return word_tokenize
+    except LookupError:
+        print("punkt is not installed, the queries are tokenized as single sentences")
+        return lambda string: word_tokenize(string, preserve_line=True)
+
+
+def read_queries(paths):
+    queries = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            queries.extend(line.strip().split('\t')[0] for line in f if line.strip())
+    return queries
+
+
+def time_tokenizer(tokenizer, queries, repeat):
+    results = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = []
+        for query in queries:
+            try:
+                results.append(tokenizer(query))
+            except AssertionError as e:
+                results.append(("AssertionError", str(e)))
+    return results, (time.perf_counter() - start) / (repeat * len(queries))
+
+
+def parse_option():
+    parser = argparse.ArgumentParser("command line arguments for benchmarking the sql tokenizer")
+    parser.add_argument("--queries", type=str, nargs="+", default=["evaluation_examples/gold.txt",
+                                                                  "evaluation_examples/predict.txt"],
+                        help="gold or predicted sql files, one query per line (followed by a tab and the db_id).")
+    parser.add_argument("--repeat", type=int, default=5)
+
+    opt = parser.parse_args()
+
+    return opt
+
+
+if __name__ == "__main__":
+    opt = parse_option()
+    queries = read_queries(opt.queries)
+    word_tokenize = get_word_tokenize()
+
+    toks, seconds = time_tokenizer(tokenize, queries, opt.repeat)
+    nltk_toks, nltk_seconds = time_tokenizer(lambda query: nltk_tokenize(query, word_tokenize), queries, opt.repeat)
+    mismatches = [query for query, a, b in zip(queries, toks, nltk_toks) if a != b]
+    for query in mismatches[:10]:
+        print("different tokens:", query)
+    print(f"{len(queries)} queries, {len(mismatches)} with different tokens")
+    print(f"tokenize:      {seconds * 1e6:.1f} us per query")
+    print(f"nltk tokenize: {nltk_seconds * 1e6:.1f} us per query ({nltk_seconds / seconds:.1f}x)")
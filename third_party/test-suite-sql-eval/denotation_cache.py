@@ -0,0 +1,88 @@
+"""
+ On-disk cache of the denotations of gold queries, backed by SQLite.
+
+ The denotation of a gold query on a database never changes, so it is stored under the hash of the
+ database file content and of the normalized query, and later evaluations (of any model output)
+ only execute the predictions. The content hash of a database file is computed once per file
+ signature (mtime and size). Only successful executions are cached.
+"""
+
+import os
+import re
+import pickle
+import sqlite3
+import hashlib
+import threading
+
+_quoted = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_query(query: str) -> str:
+    # collapse the white space outside of the string literals, and drop the trailing semicolons
+    parts = _quoted.split(query)
+    for i in range(0, len(parts), 2):
+        parts[i] = " ".join(parts[i].split())
+    return "".join(parts).strip().rstrip(";").rstrip()
+
+
+class GoldDenotationCache(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # (db path, mtime, size) -> sha256 of the file content
+        self.file_hashes = {}
+        self.connection, self.pid = None, None
+
+    def get_connection(self):
+        # a forked worker opens its own connection
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS denotations (key TEXT PRIMARY KEY, denotation BLOB NOT NULL)"
+            )
+            self.pid = os.getpid()
+        return self.connection
+
+    def get_file_hash(self, db_path: str) -> str:
+        stat = os.stat(db_path)
+        signature = (os.path.abspath(db_path), stat.st_mtime_ns, stat.st_size)
+        if signature not in self.file_hashes:
+            sha256 = hashlib.sha256()
+            with open(db_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha256.update(block)
+            self.file_hashes[signature] = sha256.hexdigest()
+        return self.file_hashes[signature]
+
+    def get_key(self, db_path: str, query: str) -> str:
+        content = self.get_file_hash(db_path) + "\t" + normalize_query(query)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, db_path: str, query: str):
+        with self.lock:
+            row = self.get_connection().execute(
+                "SELECT denotation FROM denotations WHERE key = ?", (self.get_key(db_path, query),)
+            ).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def put(self, db_path: str, query: str, denotation) -> None:
+        data = pickle.dumps(denotation, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.get_connection().execute(
+                "INSERT OR REPLACE INTO denotations (key, denotation) VALUES (?, ?)",
+                (self.get_key(db_path, query), data),
+            )
+
+    def clear(self) -> None:
+        with self.lock:
+            self.get_connection().execute("DELETE FROM denotations")
+
+
+gold_denotation_cache = None
+
+
+def configure_gold_denotation_cache(path: str = None) -> GoldDenotationCache:
+    global gold_denotation_cache
+    gold_denotation_cache = GoldDenotationCache(path) if path is not None else None
+    return gold_denotation_cache
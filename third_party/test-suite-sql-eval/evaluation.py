@@ -23,9 +23,17 @@ import os
 import json
 import sqlite3
 import argparse
+from collections import OrderedDict
+from multiprocessing import Pool
 
-from process_sql import get_schema, Schema, get_sql
+from process_sql import get_sql, load_schema
+import sqlite_pool
+from schema_cache import load_schemas
+import exec_eval
 from exec_eval import eval_exec_match
+from denotation_cache import configure_gold_denotation_cache
+import parse_cache
+from parse_cache import configure_parsed_sql_cache
 
 # Flag to disable value evaluation
 DISABLE_VALUE = True
@@ -432,12 +440,14 @@ class Evaluator:
 
 
 def isValidSQL(sql, db):
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
-    try:
-        cursor.execute(sql)
-    except:
-        return False
+    with sqlite_pool.connection_pool.connection(db) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql)
+        except:
+            return False
+        finally:
+            cursor.close()
     return True
 
 
@@ -500,7 +510,122 @@ def print_scores(scores, etype, include_turn_acc=True):
             print_formated_s("exact match", exact_scores, '{:<20.3f}')
 
 
-def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint):
+def parse_query(schema, query):
+    """``get_sql``, through the parsed sql cache if one is configured."""
+    cache = parse_cache.parsed_sql_cache
+    if cache is None:
+        return get_sql(schema, query)
+    sql = cache.get("sql", schema, query)
+    if sql is None:
+        sql = get_sql(schema, query)
+        cache.put("sql", schema, query, sql)
+    return sql
+
+
+def rebuild_query(schema, query, sql, kmap):
+    """Value and column rebuilt form of ``sql``, the parse of ``query``, for exact matching."""
+    cache = parse_cache.parsed_sql_cache
+    if cache is not None:
+        rebuilt_sql = cache.get("rebuilt", schema, query, kmap)
+        if rebuilt_sql is not None:
+            return rebuilt_sql
+    valid_col_units = build_valid_col_units(sql['from']['table_units'], schema)
+    rebuilt_sql = rebuild_sql_val(sql)
+    rebuilt_sql = rebuild_sql_col(valid_col_units, rebuilt_sql, kmap)
+    if cache is not None:
+        cache.put("rebuilt", schema, query, rebuilt_sql, kmap)
+    return rebuilt_sql
+
+
+def evaluate_pair(evaluator, p, g, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint,
+                  table_path=None):
+    """Scores of one (pred, gold) pair, merged into the totals by ``evaluate``."""
+    p_str = p[0]
+    p_str = p_str.replace("value", "1")
+    g_str, db = g
+    db_name = db
+    db = os.path.join(db_dir, db, db + ".sqlite")
+    schema = load_schema(db, table_path)
+    g_sql = parse_query(schema, g_str)
+    hardness = evaluator.eval_hardness(g_sql)
+    result = {'p_str': p_str, 'g_str': g_str, 'hardness': hardness, 'exec': None, 'exact': None, 'partial': None}
+
+    try:
+        p_sql = parse_query(schema, p_str)
+    except:
+        # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
+        p_sql = {
+        "except": None,
+        "from": {
+            "conds": [],
+            "table_units": []
+        },
+        "groupBy": [],
+        "having": [],
+        "intersect": None,
+        "limit": None,
+        "orderBy": [],
+        "select": [
+            False,
+            []
+        ],
+        "union": None,
+        "where": []
+        }
+
+    if etype in ["all", "exec"]:
+        result['exec'] = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
+                                         keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint)
+
+    if etype in ["all", "match"]:
+        # rebuild sql for value evaluation
+        kmap = kmaps[db_name]
+        g_sql = rebuild_query(schema, g_str, g_sql, kmap)
+        p_sql = rebuild_query(schema, p_str, p_sql, kmap)
+        result['exact'] = evaluator.eval_exact_match(p_sql, g_sql)
+        result['partial'] = evaluator.partial_scores
+
+    return result
+
+
+# state of a worker process, set once by ``init_worker''
+worker_evaluator, worker_args = None, None
+
+
+def init_worker(*args):
+    global worker_evaluator, worker_args
+    worker_evaluator, worker_args = Evaluator(), args
+
+
+def evaluate_group(group):
+    return [(i, idx, evaluate_pair(worker_evaluator, p, g, *worker_args)) for i, idx, p, g in group]
+
+
+def evaluate_parallel(plist, glist, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint,
+                      num_workers, table_path=None):
+    """Scores of every (pred, gold) pair by session and turn, computed by a pool of ``num_workers`` processes."""
+    # group the pairs by database so that each worker reuses its connections
+    groups = OrderedDict()
+    for i, (p, g) in enumerate(zip(plist, glist)):
+        for idx, (p_one, g_one) in enumerate(zip(p, g)):
+            groups.setdefault(g_one[1], []).append((i, idx, p_one, g_one))
+    # split the large groups so that a few databases still keep every worker busy
+    chunks = []
+    for group in sorted(groups.values(), key=len, reverse=True):
+        chunk_size = max(1, len(group) // (num_workers * 4))
+        chunks.extend(group[start: start + chunk_size] for start in range(0, len(group), chunk_size))
+
+    results = [[None] * min(len(p), len(g)) for p, g in zip(plist, glist)]
+    with Pool(num_workers, initializer=init_worker, initargs=(db_dir, etype, kmaps, plug_value, keep_distinct,
+                                                               progress_bar_for_each_datapoint, table_path)) as pool:
+        for group_results in pool.imap_unordered(evaluate_group, chunks):
+            for i, idx, result in group_results:
+                results[i][idx] = result
+    return results
+
+
+def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, progress_bar_for_each_datapoint,
+             num_workers=1, table_path=None):
 
     with open(gold) as f:
         glist = []
@@ -558,6 +683,11 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
         for type_ in partial_types:
             scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
 
+    results = None
+    if num_workers > 1:
+        results = evaluate_parallel(plist, glist, db_dir, etype, kmaps, plug_value, keep_distinct,
+                                    progress_bar_for_each_datapoint, num_workers, table_path)
+
     for i, (p, g) in enumerate(zip(plist, glist)):
         if (i + 1) % 10 == 0:
             print('Evaluating %dth prediction' % (i + 1))
@@ -565,15 +695,12 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
         turn_scores = {"exec": [], "exact": []}
         for idx, pg in enumerate(zip(p, g)):
             # (['SELECT COUNT(*) FROM singer;'], ['SELECT count(*) FROM singer', 'concert_singer'])
-            p, g = pg
-            p_str = p[0]
-            p_str = p_str.replace("value", "1")
-            g_str, db = g
-            db_name = db
-            db = os.path.join(db_dir, db, db + ".sqlite")
-            schema = Schema(get_schema(db))
-            g_sql = get_sql(schema, g_str)
-            hardness = evaluator.eval_hardness(g_sql)
+            if results is not None:
+                result = results[i][idx]
+            else:
+                result = evaluate_pair(evaluator, pg[0], pg[1], db_dir, etype, kmaps, plug_value, keep_distinct,
+                                       progress_bar_for_each_datapoint, table_path)
+            hardness = result['hardness']
             if idx > 3:
                 idx = "> 4"
             else:
@@ -583,32 +710,8 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
             scores[hardness]['count'] += 1
             scores['all']['count'] += 1
 
-            try:
-                p_sql = get_sql(schema, p_str)
-            except:
-                # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
-                p_sql = {
-                "except": None,
-                "from": {
-                    "conds": [],
-                    "table_units": []
-                },
-                "groupBy": [],
-                "having": [],
-                "intersect": None,
-                "limit": None,
-                "orderBy": [],
-                "select": [
-                    False,
-                    []
-                ],
-                "union": None,
-                "where": []
-                }
-
             if etype in ["all", "exec"]:
-                exec_score = eval_exec_match(db=db, p_str=p_str, g_str=g_str, plug_value=plug_value,
-                                             keep_distinct=keep_distinct, progress_bar_for_each_datapoint=progress_bar_for_each_datapoint)
+                exec_score = result['exec']
                 if exec_score:
                     scores[hardness]['exec'] += 1
                     scores[turn_id]['exec'] += 1
@@ -618,16 +721,9 @@ def evaluate(gold, predict, db_dir, etype, kmaps, plug_value, keep_distinct, pro
                     turn_scores['exec'].append(0)
 
             if etype in ["all", "match"]:
-                # rebuild sql for value evaluation
-                kmap = kmaps[db_name]
-                g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
-                g_sql = rebuild_sql_val(g_sql)
-                g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
-                p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
-                p_sql = rebuild_sql_val(p_sql)
-                p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
-                exact_score = evaluator.eval_exact_match(p_sql, g_sql)
-                partial_scores = evaluator.partial_scores
+                p_str, g_str = result['p_str'], result['g_str']
+                exact_score = result['exact']
+                partial_scores = result['partial']
                 if exact_score == 0:
                     turn_scores['exact'].append(0)
                     print("{} pred: {}".format(hardness, p_str))
@@ -905,11 +1001,11 @@ def build_foreign_key_map(entry):
 
 
 def build_foreign_key_map_from_json(table):
-    with open(table) as f:
-        data = json.load(f)
+    # the tables.json entries come from the compiled schemas shared with the pipeline
+    db_schemas = load_schemas(table)
     tables = {}
-    for entry in data:
-        tables[entry['db_id']] = build_foreign_key_map(entry)
+    for db_id, db_schema in db_schemas.items():
+        tables[db_id] = build_foreign_key_map(db_schema['entry'])
     return tables
 
 
@@ -928,6 +1024,18 @@ if __name__ == "__main__":
                         help='whether to keep distinct keyword during evaluation. default is false.')
     parser.add_argument('--progress_bar_for_each_datapoint', default=False, action='store_true',
                         help='whether to print progress bar of running test inputs for each datapoint')
+    parser.add_argument('--gold_cache_path', type=str, default=None,
+                        help='sqlite file caching the denotations of the gold queries, no caching if not given.')
+    parser.add_argument('--parsed_sql_cache_path', type=str, default=None,
+                        help='sqlite file caching the parsed queries, no caching if not given.')
+    parser.add_argument('--schema_from_table', default=False, action='store_true',
+                        help='whether to read the schemas from the tables.json file instead of the databases; '
+                             'match-only evaluation then never opens a database.')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes evaluating the predictions, pairs of the same database go together.')
+    parser.add_argument('--exec_in_subprocess', default=False, action='store_true',
+                        help='whether to run every query in a subprocess killed after the timeout, for queries which '
+                             'may hang or crash the interpreter; slower.')
     args = parser.parse_args()
 
     args.gold = 'dev_gold.sql'
@@ -936,10 +1044,15 @@ if __name__ == "__main__":
     args.table = 'data/spider/tables.json'
     args.etype = 'all' 
 
+    configure_gold_denotation_cache(args.gold_cache_path)
+    exec_eval.EXEC_IN_SUBPROCESS = args.exec_in_subprocess
+    configure_parsed_sql_cache(args.parsed_sql_cache_path)
+
     # only evaluting exact match needs this argument
     kmaps = None
     if args.etype in ['all', 'match']:
         assert args.table is not None, 'table argument must be non-None if exact set match is evaluated'
         kmaps = build_foreign_key_map_from_json(args.table)
 
-    evaluate(args.gold, args.pred, args.db, args.etype, kmaps, args.plug_value, args.keep_distinct, args.progress_bar_for_each_datapoint)
+    evaluate(args.gold, args.pred, args.db, args.etype, kmaps, args.plug_value, args.keep_distinct, args.progress_bar_for_each_datapoint,
+             args.num_workers, args.table if args.schema_from_table else None)
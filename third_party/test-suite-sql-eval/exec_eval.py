@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import asyncio
 import sqlite3
 import threading
@@ -14,11 +15,21 @@ import pickle as pkl
 import subprocess
 from itertools import chain
 
+# sqlite_pool comes from src/, which must be on the PYTHONPATH
+import sqlite_pool
+from sqlite_pool import decode_text, execute_with_limits
+import denotation_cache
+
 
 
 threadLock = threading.Lock()
 TIMEOUT = 60
+# queries returning more rows than this are given up, no limit if None
+MAX_ROWS = None
+# run every query in a worker subprocess (set by evaluation.py --exec_in_subprocess)
+EXEC_IN_SUBPROCESS = False
 EXEC_TMP_DIR = 'tmp/'
+EXEC_SUBPROCESS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exec_subprocess.py')
 
 def permute_tuple(element: Tuple, perm: Tuple) -> Tuple:
     assert len(element) == len(perm)
@@ -128,45 +139,69 @@ def replace_cur_year(query: str) -> str:
     )
 
 
-# get the database cursor for a sqlite database path
-def get_cursor_from_path(sqlite_path: str):
+async def exec_on_db_(sqlite_path: str, query: str, timeout: float = TIMEOUT,
+                      max_rows: int = MAX_ROWS) -> Tuple[str, Any]:
+    query = replace_cur_year(query)
     try:
-        if not os.path.exists(sqlite_path):
-            print("Openning a new connection %s" % sqlite_path)
-        connection = sqlite3.connect(sqlite_path)
+        with sqlite_pool.connection_pool.connection(sqlite_path, decode_text) as connection:
+            return "result", execute_with_limits(connection, query, timeout, max_rows)
     except Exception as e:
-        print(sqlite_path)
-        raise e
-    connection.text_factory = lambda b: b.decode(errors="ignore")
-    cursor = connection.cursor()
-    return cursor
+        return "exception", e
 
 
-async def exec_on_db_(sqlite_path: str, query: str) -> Tuple[str, Any]:
-    query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
+# run the query in a separate process which is killed after the timeout,
+# for queries that sqlite cannot interrupt or that may crash the interpreter
+def exec_on_db_subprocess(sqlite_path: str, query: str, process_id: str = "", timeout: float = TIMEOUT,
+                          max_rows: int = MAX_ROWS) -> Tuple[str, Any]:
+    os.makedirs(EXEC_TMP_DIR, exist_ok=True)
+    f_prefix = os.path.join(EXEC_TMP_DIR, "%s_%d_%d" % (process_id, os.getpid(), threading.get_ident()))
+    with open(f_prefix + '.in', 'wb') as f:
+        pkl.dump((sqlite_path, query, timeout, max_rows), f)
     try:
-        cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
-        return "result", result
+        # the subprocess stops the query itself after the timeout, the kill is the last resort
+        subprocess.run([sys.executable, EXEC_SUBPROCESS_PATH, f_prefix], timeout=timeout + 5,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(f_prefix + '.out', 'rb') as f:
+            return pkl.load(f)
+    except subprocess.TimeoutExpired:
+        return 'exception', TimeoutError("query runs longer than %s seconds" % timeout)
     except Exception as e:
-        cursor.close()
-        cursor.connection.close()
-        return "exception", e
+        return 'exception', e
+    finally:
+        for suffix in ['.in', '.out']:
+            if os.path.exists(f_prefix + suffix):
+                os.remove(f_prefix + suffix)
+
 
+# the timeout is enforced inside sqlite (or by killing the subprocess),
+# asyncio.wait_for could not interrupt the blocking call
 async def exec_on_db(
-    sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT
+    sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT, max_rows: int = MAX_ROWS,
+    in_subprocess: bool = None
 ) -> Tuple[str, Any]:
+    if in_subprocess is None:
+        in_subprocess = EXEC_IN_SUBPROCESS
     try:
-        return await asyncio.wait_for(exec_on_db_(sqlite_path, query), timeout)
-    except asyncio.TimeoutError:
-        return ('exception', TimeoutError)
+        if in_subprocess:
+            return exec_on_db_subprocess(sqlite_path, query, process_id, timeout, max_rows)
+        return await exec_on_db_(sqlite_path, query, timeout, max_rows)
     except Exception as e:
         return ("exception", e)
 
 
+# the denotation of a gold query is read from the gold denotation cache when one is configured
+def exec_gold_on_db(sqlite_path: str, query: str) -> Tuple[str, Any]:
+    cache = denotation_cache.gold_denotation_cache
+    if cache is not None:
+        denotation = cache.get(sqlite_path, query)
+        if denotation is not None:
+            return "result", denotation
+    flag, denotation = asyncio.run(exec_on_db(sqlite_path, query))
+    if cache is not None and flag == "result":
+        cache.put(sqlite_path, query, denotation)
+    return flag, denotation
+
+
 # postprocess the model predictions to avoid execution errors
 # e.g. removing spaces between ">" and "="
 def postprocess(query: str) -> str:
@@ -210,6 +245,8 @@ def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_dist
         # this reduces "false negatives" when value is substituted
         preds = chain([p_str], preds)
 
+    # the gold denotations are the same for every prediction
+    g_results = {}
     for pred in preds:
 
         pred_passes = 1
@@ -221,7 +258,9 @@ def eval_exec_match(db: str, p_str: str, g_str: str, plug_value: bool, keep_dist
             ranger = db_paths
 
         for db_path in ranger:
-            g_flag, g_denotation = asyncio.run(exec_on_db(db_path, g_str))
+            if db_path not in g_results:
+                g_results[db_path] = exec_gold_on_db(db_path, g_str)
+            g_flag, g_denotation = g_results[db_path]
             p_flag, p_denotation = asyncio.run(exec_on_db(db_path, pred))
 
             # we should expect the gold to be succesfully executed on the database
@@ -0,0 +1,87 @@
+"""
+ On-disk cache of parsed queries, backed by SQLite.
+
+ Parsing a query only depends on the schema it is parsed against and on its text, so the output of
+ ``get_sql`` is stored under the hash of the schema content (table and column names) and of the query
+ text, and gold queries or identical predictions are parsed once across evaluations. The rebuilt
+ forms used by exact matching (``rebuild_sql_val`` then ``rebuild_sql_col``) are stored the same way,
+ with the foreign key map they depend on added to the key. Only successful parses are cached, and
+ every lookup returns a fresh copy since the rebuilding functions modify the sql in place.
+"""
+
+import os
+import json
+import pickle
+import sqlite3
+import hashlib
+import threading
+import weakref
+
+# bumped whenever the parser or the rebuilding functions give another output
+PARSE_CACHE_VERSION = 1
+
+
+class ParsedSQLCache(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # Schema -> sha256 of its table and column names
+        self.schema_ids = weakref.WeakKeyDictionary()
+        # key -> pickled sql, for the queries seen by this process
+        self.memory = {}
+        self.connection, self.pid = None, None
+
+    def get_connection(self):
+        # a forked worker opens its own connection
+        if self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, sql BLOB NOT NULL)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def get_schema_id(self, schema) -> str:
+        if schema not in self.schema_ids:
+            content = json.dumps(schema.schema, sort_keys=True)
+            self.schema_ids[schema] = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        return self.schema_ids[schema]
+
+    def get_key(self, form: str, schema, query: str, kmap: dict = None) -> str:
+        content = "\t".join([str(PARSE_CACHE_VERSION), form, self.get_schema_id(schema), query])
+        if kmap is not None:
+            content += "\t" + json.dumps(kmap, sort_keys=True)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, form: str, schema, query: str, kmap: dict = None):
+        """The cached ``form`` ("sql" or "rebuilt") of ``query``, None if it was never stored."""
+        key = self.get_key(form, schema, query, kmap)
+        with self.lock:
+            if key not in self.memory:
+                row = self.get_connection().execute("SELECT sql FROM parsed WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                self.memory[key] = row[0]
+            data = self.memory[key]
+        return pickle.loads(data)
+
+    def put(self, form: str, schema, query: str, sql: dict, kmap: dict = None) -> None:
+        key = self.get_key(form, schema, query, kmap)
+        data = pickle.dumps(sql, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.memory[key] = data
+            self.get_connection().execute("INSERT OR REPLACE INTO parsed (key, sql) VALUES (?, ?)", (key, data))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
+            self.get_connection().execute("DELETE FROM parsed")
+
+
+parsed_sql_cache = None
+
+
+def configure_parsed_sql_cache(path: str = None) -> ParsedSQLCache:
+    global parsed_sql_cache
+    parsed_sql_cache = ParsedSQLCache(path) if path is not None else None
+    return parsed_sql_cache
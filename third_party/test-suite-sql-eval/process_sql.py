@@ -24,9 +24,14 @@
 # }
 ################################
 
+import os
+import re
 import json
-import sqlite3
-from nltk import word_tokenize
+import functools
+
+# sqlite_pool (and schema_cache) come from src/, which must be on the PYTHONPATH
+import sqlite_pool
+from schema_cache import load_schemas
 
 CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group', 'order', 'limit', 'intersect', 'union', 'except')
 JOIN_KEYWORDS = ('join', 'on', 'as')
@@ -85,22 +90,29 @@ def get_schema(db):
     """
 
     schema = {}
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    with sqlite_pool.connection_pool.connection(db) as conn:
+        cursor = conn.cursor()
 
-    # fetch table names
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = [str(table[0].lower()) for table in cursor.fetchall()]
+        # fetch table names
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        tables = [str(table[0].lower()) for table in cursor.fetchall()]
 
-    # fetch table info
-    for table in tables:
-        cursor.execute("PRAGMA table_info({})".format(table))
-        schema[table] = [str(col[1].lower()) for col in cursor.fetchall()]
+        # fetch table info
+        for table in tables:
+            cursor.execute("PRAGMA table_info({})".format(table))
+            schema[table] = [str(col[1].lower()) for col in cursor.fetchall()]
+        cursor.close()
 
     return schema
 
 
-def get_schema_from_json(fpath):
+def get_schema_from_json(fpath, db_id=None):
+    if db_id is not None:
+        # a spider tables.json file, whose compiled schemas have lower cased names already
+        db_schema = load_compiled_schemas(fpath)[db_id]
+        return {table['table_name_original']: list(table['column_names_original'])
+                for table in db_schema['schema_items']}
+
     with open(fpath) as f:
         data = json.load(f)
 
@@ -113,36 +125,118 @@ def get_schema_from_json(fpath):
     return schema
 
 
+@functools.lru_cache(maxsize=None)
+def load_compiled_schemas(fpath):
+    return load_schemas(fpath)
+
+
+@functools.lru_cache(maxsize=None)
+def load_schema(db, table_path=None):
+    """
+    Schema of the database file ``db``, or of its entry in the tables.json file ``table_path``
+    (without opening the database), built once per process
+    """
+    if table_path is not None:
+        db_id = os.path.splitext(os.path.basename(db))[0]
+        return Schema(get_schema_from_json(table_path, db_id))
+    return Schema(get_schema(db))
+
+
+# pieces of a query, split as nltk's word_tokenize splits them: string values, white space, characters
+# always split off, runs of backticks, commas and colons (split off unless a digit follows) and words
+_separators = "()\\[\\]{}<>*;@#$%&?!\u2012-\u2015\u00ab\u201c\u2018\u201e\u00bb\u201d\u2019"
+_token = re.compile(r"""
+    (?P<value>["'][^"']*["'])
+  | (?P<space>\s+)
+  | (?P<punct>[{0}]|\.{{2,}}|--)
+  | (?P<ticks>`+)
+  | (?P<comma>[:,])
+  | (?P<word>(?:[^\s"'`:,.\-{0}]|\.(?!\.)|-(?!-))+)
+""".format(_separators), re.VERBOSE)
+# the period ending the query, only followed by closing brackets and spaces
+_final_period = re.compile(r"[^.](\.)[\])}>\u00bb\u201d\u2019 ]*\s*$")
+# contractions nltk splits in two words
+_contraction = re.compile(r"(?i)cannot|gimme|gonna|gotta|lemme|wanna")
+_contractions = [re.compile(pattern) for pattern in (
+    r"(?i)\b(can)(not)\b", r"(?i)\b(gim)(me)\b", r"(?i)\b(gon)(na)\b", r"(?i)\b(got)(ta)\b",
+    r"(?i)\b(lem)(me)\b", r"(?i)\b(wan)(na)(?=\s)")]
+
+
+def add_word(toks, pieces, vals, split_contractions):
+    """Add the word made of ``pieces`` (string values replaced by their keys) to ``toks``."""
+    word = "".join(pieces).lower() if len(pieces) > 1 else pieces[0].lower()
+    del pieces[:]
+    if split_contractions and _contraction.search(word):
+        word += " "
+        for regexp in _contractions:
+            word = regexp.sub(r" \1 \2 ", word)
+        for word in word.split():
+            add_word(toks, [word], vals, False)
+        return
+    if vals:
+        word = vals.get(word, word)
+    # find if there exists !=, >=, <=
+    if word == "=" and toks and toks[-1] in ('!', '>', '<'):
+        toks[-1] += word
+    else:
+        toks.append(word)
+
+
 def tokenize(string):
     string = str(string)
-    string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
-    quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
-    assert len(quote_idxs) % 2 == 0, "Unexpected quote"
+    assert (string.count('"') + string.count("'")) % 2 == 0, "Unexpected quote"
+    match = _final_period.search(string) if "." in string else None
+    final_period_idx = match.start(1) if match is not None else -1
+    split_contractions = _contraction.search(string) is not None
 
-    # keep string value as token
+    # keep string value as token (all string values wrapped by "")
     vals = {}
-    for i in range(len(quote_idxs)-1, -1, -2):
-        qidx1 = quote_idxs[i-1]
-        qidx2 = quote_idxs[i]
-        val = string[qidx1: qidx2+1]
-        key = "__val_{}_{}__".format(qidx1, qidx2)
-        string = string[:qidx1] + key + string[qidx2+1:]
-        vals[key] = val
-
-    toks = [word.lower() for word in word_tokenize(string)]
-    # replace with string value token
-    for i in range(len(toks)):
-        if toks[i] in vals:
-            toks[i] = vals[toks[i]]
-
-    # find if there exists !=, >=, <=
-    eq_idxs = [idx for idx, tok in enumerate(toks) if tok == "="]
-    eq_idxs.reverse()
-    prefix = ('!', '>', '<')
-    for eq_idx in eq_idxs:
-        pre_tok = toks[eq_idx-1]
-        if pre_tok in prefix:
-            toks = toks[:eq_idx-1] + [pre_tok + "="] + toks[eq_idx+1: ]
+    toks, pieces = [], []
+    # index of the last comma split off together with the character after it
+    comma_idx = -2
+    for match in _token.finditer(string):
+        kind = match.lastgroup
+        if kind == "word":
+            text = match.group()
+            if match.end() - 1 != final_period_idx:
+                pieces.append(text)
+                continue
+            if len(text) > 1:
+                pieces.append(text[:-1])
+            if pieces:
+                add_word(toks, pieces, vals, split_contractions)
+            toks.append(".")
+        elif kind == "space":
+            if pieces:
+                add_word(toks, pieces, vals, split_contractions)
+        elif kind == "value":
+            text = match.group()
+            key = "__val_{}_{}__".format(match.start(), match.end() - 1)
+            vals[key] = '"' + text[1:-1] + '"'
+            pieces.append(key)
+        elif kind == "comma":
+            start = match.start()
+            if start == comma_idx + 1 or (start + 1 < len(string) and string[start + 1].isdecimal()):
+                pieces.append(match.group())
+                continue
+            if pieces:
+                add_word(toks, pieces, vals, split_contractions)
+            toks.append(match.group())
+            comma_idx = start
+        else:
+            if pieces:
+                add_word(toks, pieces, vals, split_contractions)
+            text = match.group()
+            if kind == "punct":
+                toks.append(text)
+            else:
+                toks.extend(["``"] * (len(text) // 2) + ["`"] * (len(text) % 2))
+    if pieces:
+        add_word(toks, pieces, vals, split_contractions)
+
+    # a leading = takes the last token as the one before it, as the list repair always did
+    if toks and toks[0] == "=" and toks[-1] in ('!', '>', '<'):
+        toks = toks[:-1] + [toks[-1] + "="] + toks[1:]
 
     return toks
 